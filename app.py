@@ -1,15 +1,15 @@
 from pathlib import Path
-from shiny import App, reactive, render, ui
+from shiny import App, reactive, render, ui, req
 
 from shinywidgets import render_plotly
 from faicons import icon_svg
 
 import definitions.layout_styles as styles
-from definitions.backend_calculations import detect_models, compute_overlap
-from definitions.backend_dynamic_plots import plot_overlap
-
+from definitions.backend_calculations import detect_models, detect_terms, compute_overlap, compute_overlaps, \
+    pairwise_overlap_table
+from definitions.backend_dynamic_plots import plot_overlap, CLIENT_BENCHMARK_JS
 from definitions.ui_functions import welcome_page, main_results_page, overlap_page, \
-    describe_input_folder, update_single_result
+    describe_input_folder, update_single_result, resolve_resolution, html_table, warm_up
 
 
 here = Path(__file__).parent
@@ -27,6 +27,7 @@ vww_blue = '#001f60'
 vww_red = '#95013a'
 vww_grey = '#c7cfe2'
 vww_pink = '#d4acb8'
+
 # ======================================================================================================================
 
 app_ui = ui.page_fillable(
@@ -55,6 +56,9 @@ app_ui = ui.page_fillable(
         window_title='Verywise Wizard',
         id='navbar'),
 
+    # Short benchmark of the browser, to choose the resolution of the 3D brains ('auto')
+    ui.head_content(ui.tags.script(CLIENT_BENCHMARK_JS)),
+
     padding=styles.PAGE_PADDING,
     gap=styles.PAGE_GAP,
 )
@@ -62,6 +66,9 @@ app_ui = ui.page_fillable(
 
 def app_server(input, output, session):
 
+    # Import the plotting modules and load the default meshes in the background (after the first page is served)
+    warm_up()
+
     # Extract results from folder or link 
     @reactive.Calc
     @reactive.event(input.go_button)
@@ -91,8 +98,27 @@ def app_server(input, output, session):
     def overlap_results():
         return compute_overlap(model1=model1(), term1=term1(), measure1=measure1(),
                                model2=model2(), term2=term2(), measure2=measure2(),
-                               resdir=all_results()['results_directory'],
-                               resformat=all_results()['results_format'])
+                               all_results=all_results())
+
+    @render.ui
+    def overlap_more_terms_ui():
+        return ui.input_selectize(
+            id='overlap_more_terms',
+            label=f'Compare with more terms of {model1()} ({measure1()})',
+            choices=detect_terms(all_results=all_results(), which_model=model1(), which_meas=measure1()),
+            multiple=True)
+
+    @render.ui
+    def overlap_table():
+        more_terms = input.overlap_more_terms() if 'overlap_more_terms' in input else ()
+        req(more_terms)
+
+        terms = [(model1(), term1(), measure1()), (model2(), term2(), measure2())] + \
+            [(model1(), term, measure1()) for term in more_terms]
+        names = [f'{model} {detect_terms(all_results(), model, meas)[int(term)]} ({meas})'
+                 for model, term, meas in terms]
+
+        return html_table(pairwise_overlap_table(compute_overlaps(terms, all_results()), names), '{:.3f}'.format)
 
     @render.text
     def overlap_info():
@@ -114,7 +140,7 @@ def app_server(input, output, session):
     def overlap_brain3D():
         return plot_overlap(overlap_maps = overlap_results()[1],
                             surf=input.overlap_select_surface(),
-                            resol=input.overlap_select_resolution())
+                            resol=resolve_resolution(input.overlap_select_resolution(), session))
 
     @render_plotly
     def overlap_brain_left():
@@ -0,0 +1,89 @@
+import sys
+import time
+import argparse
+import statistics
+from pathlib import Path
+
+# ===== HEMISPHERE BENCHMARK ===========================================================================================
+# Wall-clock time of the per-update work of the app (reading the maps of a term, coloring both brains, and the overlap
+# brains of two terms) at each fsaverage resolution, with the hemispheres processed one after the other
+# (VWW_HEMI_WORKERS=1) and concurrently (see map_hemis in definitions/backend_io.py).
+# Usage: python benchmarks/hemispheres.py [--resolutions fsaverage5 fsaverage6 fsaverage] [--repeats 5]
+
+here = Path(__file__).parent
+root = here.parent
+sys.path.insert(0, str(root))
+
+import definitions.backend_io as backend_io  # noqa: E402
+from definitions.backend_calculations import detect_models, extract_results, compute_overlap, \
+    significance_index  # noqa: E402 (after the path of the repository is added)
+from definitions.backend_dynamic_plots import surfmap_colors, plot_overlap  # noqa: E402
+
+
+def update(all_results, which_model, meas, terms, resol):
+    """Seconds taken by each step of a Main results update and an Overlap update."""
+    resdir, resformat = str(all_results['results_directory']), all_results['results_format']
+    backend_io.RESULT_CACHE.clear()  # maps are read again (from the OS page cache) in every run
+
+    times = {}
+    start = time.perf_counter()
+    min_beta, max_beta, mean_beta, n_clusters, sign_clusters, sign_betas, all_betas = extract_results(
+        which_model, terms[0], meas, resdir, resformat)
+    times['extract_results'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    surfmap_colors(min_beta, max_beta, n_clusters, sign_clusters, sign_betas, resol=resol, output='betas')
+    times['surfmap_colors'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, overlap_maps = compute_overlap(which_model, terms[0], meas, which_model, terms[1], meas, all_results)
+    plot_overlap(overlap_maps, resol=resol)
+    times['overlap'] = time.perf_counter() - start
+
+    times['total'] = sum(times.values())
+    return times
+
+
+def benchmark(all_results, which_model, meas, terms, resol, repeats, workers):
+    backend_io.HEMI_WORKERS = workers
+    runs = [update(all_results, which_model, meas, terms, resol) for _ in range(repeats)]
+    return {step: statistics.median(run[step] for run in runs) for step in runs[0]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the effect of processing the hemispheres concurrently.')
+    parser.add_argument('--resdir', default=str(root / 'verywise_example_results'), help='Results directory')
+    parser.add_argument('--format', default='verywise', choices=['verywise', 'QDECR'], help='Results format')
+    parser.add_argument('--model', default=None, help='Model (group/model, default: the first one)')
+    parser.add_argument('--measure', default=None, help='Measure (default: the first one of the model)')
+    parser.add_argument('--terms', nargs=2, type=int, default=None,
+                        help='Terms (stack numbers) to load (default: the two with the most significant vertices)')
+    parser.add_argument('--resolutions', nargs='+', default=['fsaverage5', 'fsaverage6', 'fsaverage'],
+                        help='Surface resolutions')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of runs of each configuration')
+    parser.add_argument('--workers', type=int, default=max(2, backend_io.HEMI_WORKERS),
+                        help='Hemisphere threads of the concurrent runs (default: VWW_HEMI_WORKERS, at least 2)')
+    args = parser.parse_args()
+
+    all_results = detect_models(args.resdir, results_format=args.format)
+    group = sorted(all_results['results'])[0]
+    which_model = args.model or f'{group}/{sorted(all_results["results"][group].model.unique())[0]}'
+    group_df = all_results['results'][which_model.split('/')[0]]
+    meas = args.measure or sorted(group_df.loc[group_df.model == which_model.split('/')[1], 'meas'].unique())[0]
+    counts = significance_index(all_results, which_model, meas).counts()
+    terms = args.terms or sorted(counts, key=counts.get, reverse=True)[:2]
+
+    print(f'{which_model} ({meas}), terms {terms[0]} and {terms[1]}, median of {args.repeats} runs')
+    print(f'{"resolution":<12}{"step":<18}{"sequential":>12}{"concurrent":>12}{"speed-up":>10}')
+    for resol in args.resolutions:
+        try:
+            update(all_results, which_model, meas, terms, resol)  # meshes, resampling operators and summaries
+        except Exception as error:  # e.g. the meshes of this resolution cannot be downloaded
+            print(f'{resol:<12}skipped ({error})')
+            continue
+
+        sequential = benchmark(all_results, which_model, meas, terms, resol, args.repeats, workers=1)
+        concurrent = benchmark(all_results, which_model, meas, terms, resol, args.repeats, workers=args.workers)
+        for step in sequential:
+            print(f'{resol:<12}{step:<18}{sequential[step] * 1000:10.1f}ms{concurrent[step] * 1000:10.1f}ms'
+                  f'{sequential[step] / concurrent[step]:9.2f}x')
@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+import statistics
+import urllib.request
+from pathlib import Path
+
+# ===== STARTUP BENCHMARK ==============================================================================================
+# Time-to-first-page of a new app worker: the time from starting `shiny run app.py` until the welcome page is served,
+# and the time to import app.py alone (with the heavy modules it pulls in).
+# Usage: python benchmarks/startup.py [--repeats 5]
+
+here = Path(__file__).parent
+root = here.parent
+
+HEAVY_MODULES = ('matplotlib', 'matplotlib.pyplot', 'mpl_toolkits.mplot3d', 'pandas', 'scipy', 'nibabel', 'nilearn',
+                 'plotly.graph_objects')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def time_import(app_module='app'):
+    """Seconds to import the app module in a new interpreter, and the heavy modules it imported."""
+    code = (f'import sys, time; t = time.perf_counter(); import {app_module}; t = time.perf_counter() - t; '
+            f'print(t); print(" ".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))')
+    out = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], cwd=root, capture_output=True, text=True,
+                         check=True).stdout.splitlines()
+    return float(out[0]), out[1].split() if len(out) > 1 else []
+
+
+def time_first_page(app_file='app.py', timeout=120):
+    """Seconds from starting the app server until it serves the welcome page."""
+    port = free_port()
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'shiny', 'run', app_file, '--port', str(port)], cwd=root,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=timeout) as resp:
+                    if resp.status == 200:
+                        resp.read()
+                        return time.perf_counter() - start
+            except OSError:  # not listening yet
+                time.sleep(0.02)
+        raise TimeoutError(f'The app did not serve its first page within {timeout} s')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def summarise(name, times):
+    print(f'{name:<20} median {statistics.median(times):6.2f} s   min {min(times):6.2f} s   (n={len(times)})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the cold start (time-to-first-page) of the app.')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of cold starts measured')
+    args = parser.parse_args()
+
+    os.environ.setdefault('PYTHONPATH', str(root))
+
+    import_times, heavy = [], []
+    for _ in range(args.repeats):
+        t, heavy = time_import()
+        import_times.append(t)
+
+    page_times = [time_first_page() for _ in range(args.repeats)]
+
+    summarise('import app.py', import_times)
+    summarise('time to first page', page_times)
+    print('heavy modules imported at startup:', ', '.join(heavy) if heavy else 'none')
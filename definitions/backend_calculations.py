@@ -1,19 +1,17 @@
 import os
 import re
+import json
+import functools
 import numpy as np
-import pandas as pd
-import warnings
 from pathlib import Path
-
-from nilearn import datasets
-import nibabel as nb
-
-import matplotlib as mpl
-from matplotlib.colors import ListedColormap
-
-from shiny import ui
+from collections import namedtuple
 
 import definitions.layout_styles as styles
+from definitions.backend_remote import download_github_folder, fetch_archive, extract_results_archive, is_archive
+from definitions.backend_surfaces import FsaverageSurfaces
+from definitions.backend_io import load_map, read_stack_names, open_pack, split_stack_name, PACK_FILENAME, ResultCache, \
+    read_term_summary, write_summaries, map_signature, mask_index_path, read_mask_index, write_mask_index, \
+    vertex_table_path, read_vertex_table, write_vertex_table, map_hemis, sidecar_path, write_sidecar_json, SidecarCache
 
 here = Path(__file__).parent
 
@@ -23,89 +21,113 @@ def resolve_resdir(resdir):
 
     if os.path.isdir(resdir):
         return resdir
+
+    # Local or remote (zip / tar) archive
+    if is_archive(resdir):
+        if re.match(r"https?://", resdir):
+            return extract_results_archive(fetch_archive(resdir))
+
+        if os.path.isfile(resdir):
+            return extract_results_archive(resdir)
     
     # GitHub folder URL
     if re.match(r"https://github.com/.+/.+/tree/.+/.+", resdir):
 
         return download_github_folder(resdir)
     
-    # (Handle other cases: zip, repo, etc.)
     raise ValueError("Folder specified in path does not exist")
 
-def download_github_folder(github_url, download_loc = here.parent, github_token=None, GITHUB_FOLDER_CACHE = {}):
+
+# Small index of the results directory, persisted in its sidecar directory (see backend_io) so that re-scanning only
+# lists the directories that changed (i.e. whose modification time changed) since the last scan
+INDEX_FILENAME = 'index.json'
+INDEX_VERSION = 1
+
+
+def read_directory_index(resdir):
+    try:
+        with open(sidecar_path(resdir, INDEX_FILENAME)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return index.get('dirs', {}) if index.get('version') == INDEX_VERSION else {}
+
+
+def write_directory_index(resdir, index_dirs):
+    # (if it cannot be written, e.g. without a writable cache, the directory is just scanned again next time)
+    write_sidecar_json(sidecar_path(resdir, INDEX_FILENAME), {'version': INDEX_VERSION, 'dirs': index_dirs})
+
+
+def list_result_directory(path):
+    """List the sub-directories and the coef.mgh files (including those in a result pack) of one directory."""
+    subdirs, files = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif entry.name.endswith('coef.mgh'):
+                files.append(entry.name)
+            elif entry.name == PACK_FILENAME:
+                # Maps consolidated in a result pack are listed as if they were still separate files
+                files.extend(f for f in open_pack(path).members() if f.endswith('coef.mgh'))
+
+    return sorted(subdirs), sorted(set(files))
+
+
+def parse_result_file(resdir, reldir, file_name, results_format):
+    """Parse the [group, model, hemi, meas, stack] of one result file from its location and name."""
+    stack = split_stack_name(file_name)[1]
+
+    if results_format == 'verywise':
+        model = reldir if reldir else os.path.basename(os.path.normpath(resdir))
+        hemi, meas = parse_verywise_filenames(file_name)  # Extract hemi and meas from filename
+        return [model, model, hemi, meas, stack]
+
+    elif results_format == 'QDECR':  #TODO: adapt this to all QDECR formats
+        model, hemi, meas = parse_qdecr_filenames(os.path.basename(reldir))
+        group = os.path.dirname(reldir)
+        return [group, model, hemi, meas, stack]
+
+
+def parse_directory_structure(resdir, results_format):
     """
-    Downloads a folder from a public GitHub repo to a temp directory.
-    github_url: e.g. https://github.com/user/repo/tree/main/path/to/folder
-    Returns the local path to the downloaded folder.
+    Recursively find all result (coef.mgh) files in a directory, including nested directories, and parse them
+    into [group, model, hemi, meas, stack] rows. Listings and parsed rows are cached per directory in the index file,
+    so directories that did not change since the last scan are only stat-ed.
     """
-    import requests
-    import shutil
+    resdir = os.fspath(resdir)
 
-    # Check cache first
-    if github_url in GITHUB_FOLDER_CACHE:
-        return GITHUB_FOLDER_CACHE[github_url]
-    
-    m = re.match(r"https://github.com/([^/]+)/([^/]+)/tree/([^/]+)/(.*)", github_url)
-    if not m:
-        raise ValueError("URL must be of the form https://github.com/user/repo/tree/branch/path/to/folder")
-    user, repo, branch, folder_path = m.groups()
-
-    api_url = f"https://api.github.com/repos/{user}/{repo}/contents/{folder_path}?ref={branch}"
-    # tmp_dir = .mkdtemp()
-    folder_local = Path(download_loc) / 'tmp_results' # todo folder name
-    
-    if folder_local.exists() and folder_local.is_dir():
-        shutil.rmtree(folder_local, ignore_errors=True)
-    
-    os.makedirs(folder_local)
-
-    headers = {}
-    # Try to get token from environment if not provided
-    if github_token is None:
-        github_token = os.environ.get("GITHUB_TOKEN")
-    if github_token:
-        headers["Authorization"] = f"token {github_token}"
-
-    def download_contents(api_url, local_dir, print_progress=True):
-        resp = requests.get(api_url, headers=headers)
-        resp.raise_for_status()
-        element_count = len(resp.json())
-        with ui.Progress(min=0, max=element_count) as p:
-            for e, file_info in enumerate(resp.json()):
-
-                if print_progress: 
-                    p.set(value=e + 1, message=f"Downloading [{e + 1}/{element_count}]: {file_info['name']}...")
-                else: 
-                    p.set(value=e + 1, message=f"[{e + 1}/{element_count}]: {file_info['name']}...")
-
-                if file_info["type"] == "dir":
-                    subfolder_local = os.path.join(local_dir, file_info["name"])
-                    os.makedirs(subfolder_local, exist_ok=True)
-                    download_contents(file_info["url"], subfolder_local, print_progress=False)
-
-                elif file_info["type"] == "file":
-                    file_resp = requests.get(file_info["download_url"])
-                    file_resp.raise_for_status()
-                    with open(os.path.join(local_dir, file_info["name"]), "wb") as f:
-                        f.write(file_resp.content)
-                
-
-    download_contents(api_url, folder_local)
-
-    # Store in cache
-    GITHUB_FOLDER_CACHE[github_url] = folder_local
-
-    return folder_local
-
-
-def parse_directory_structure(resdir):
-    """Recursively find all .mgh files in a directory, including nested directories."""
-    files = []
-    for root, dirs, filenames in os.walk(resdir):
-        for filename in filenames:
-            if filename.endswith('coef.mgh'):
-                files.append(os.path.join(root, filename))
-    return files
+    old_index = read_directory_index(resdir)
+    new_index = {}
+    changed = False
+
+    rows = []
+    to_scan = ['']
+    while to_scan:
+        reldir = to_scan.pop()
+        path = os.path.join(resdir, reldir)
+
+        mtime = os.stat(path).st_mtime_ns
+        entry = old_index.get(reldir)
+
+        if entry is None or entry['mtime_ns'] != mtime:
+            subdirs, files = list_result_directory(path)
+            entry = dict(mtime_ns=mtime, subdirs=subdirs, files=files, rows={})
+            changed = True
+
+        if results_format not in entry['rows']:
+            entry['rows'][results_format] = [parse_result_file(resdir, reldir, f, results_format)
+                                             for f in entry['files']]
+            changed = True
+
+        new_index[reldir] = entry
+        rows.extend(entry['rows'][results_format])
+        to_scan.extend(os.path.join(reldir, d) for d in reversed(entry['subdirs']))
+
+    if changed or new_index.keys() != old_index.keys():
+        write_directory_index(resdir, new_index)
+
+    return rows
 
 
 def parse_verywise_filenames(d, special_meas_names = ['area.pial', 'w_g.pct', 'white.H', 'white.K']):
@@ -148,41 +170,16 @@ def detect_models(resdir, results_format):
                    'results_format': results_format,
                    'results': {}}
 
-    all_files = parse_directory_structure(resdir)
+    all_files = parse_directory_structure(resdir, results_format)
 
     if not all_files:
         raise ValueError("No .mgh files found in the specified directory.")
 
-    # top_level = [f for f in os.listdir(resdir) if os.path.isdir(f'{resdir}/{f}') and not f.startswith('.')]
-    res = pd.DataFrame(columns=['group', 'model', 'hemi', 'meas'])
-    
-    if results_format == 'verywise':
-
-        for file_path in all_files:
-            parent_dir = os.path.dirname(file_path)
-            file_name = os.path.basename(file_path)
+    import pandas as pd
 
-            if parent_dir == resdir: 
-                model = os.path.basename(parent_dir)
-            else:
-                model = parent_dir.replace(f'{resdir}/', '')
-
-            hemi, meas = parse_verywise_filenames(file_name)  # Extract hemi and meas from filename
-
-            res = pd.concat([res, pd.DataFrame(dict(group=[model], model=[model], hemi=[hemi], meas=[meas]))],
-                             ignore_index=True)
-    
-    elif results_format == 'QDECR': #TODO: adapt this to all QDECR formats
-
-         for file_path in all_files:
-            parent_dir = os.path.dirname(file_path)
-            file_name = os.path.basename(file_path)
-
-            model, hemi, meas = parse_qdecr_filenames(os.path.basename(parent_dir))
-            group = os.path.dirname(parent_dir.replace(f'{resdir}/', ''))
-
-            res = pd.concat([res, pd.DataFrame(dict(group=[group], model=[model], hemi=[hemi], meas=[meas]))],
-                             ignore_index=True)
+    # Build the frame once from all parsed rows (stack numbers are only needed in the index)
+    res = pd.DataFrame([row[:4] for row in all_files if row is not None], 
+                       columns=['group', 'model', 'hemi', 'meas'])
 
     res = res.drop_duplicates()
 
@@ -216,28 +213,89 @@ def detect_terms(all_results, which_model, which_meas):
         check_hemis = check_df['hemi'].unique()
         mdir = f'{resdir}/{group}/{check_hemis[0]}.{model}.{which_meas}'
 
-    stacks = pd.read_table(os.path.join(mdir, 'stack_names.txt'), delimiter="\t")
+    stacks = read_stack_names(mdir)
 
     out_terms = dict(zip(list(stacks.stack_number)[1:], list(stacks.stack_name)[1:]))
 
     return out_terms
 
 
-def extract_results(which_model, which_term, which_meas, 
-                    resdir, resformat):
-
+def result_files(which_model, which_term, which_meas, resdir, resformat):
+    """Location of the maps of one term: {hemi: (model directory, cluster map file name, beta map file name)}."""
     group, model = which_model.split('/')
 
-    if resformat == 'verywise':
-        if group != model:
-            mdir = f'{resdir}/{group}/{model}'
-        else:
-            mdir = f'{resdir}/{group}'
+    files = {}
+    for hemi in ['left', 'right']:
+        if resformat == 'QDECR':
+            mdir = os.path.join(resdir, group, f'{hemi[0]}h.{model}.{which_meas}')
+            prefix = f'stack{which_term}'
+
+        elif resformat == 'verywise':
+            mdir = f'{resdir}/{group}/{model}' if group != model else f'{resdir}/{group}'
+            prefix = f'{hemi[0]}h.{which_meas}.stack{which_term}'
+
+        files[hemi] = (mdir, f'{prefix}.cache.th30.abs.sig.ocn.mgh', f'{prefix}.coef.mgh')
+
+    return files
+
+
+def term_summary(mdir, ocn_name, coef_name, sign_clusters=None, coef=None):
+    """
+    Summary of one term (hemisphere) from the result pack or summary sidecar of its model directory. If there is none
+    yet, it is computed from the maps (loaded if not given) and stored in the sidecar, so this happens only once.
+    """
+    summary = read_term_summary(mdir, coef_name, ocn_name)
+
+    if summary is None:
+        if sign_clusters is None or coef is None:
+            sign_clusters = load_map(os.path.join(mdir, ocn_name))
+            coef = load_map(os.path.join(mdir, coef_name))
+
+        summary = summarise_term(sign_clusters, coef)
+        write_summaries(mdir, {coef_name: dict(summary, source=[map_signature(os.path.join(mdir, f))
+                                                                 for f in (coef_name, ocn_name)])})
+    return summary
+
+
+def hemi_results(mdir, ocn_name, coef_name):
+    """
+    Results of one hemisphere (see extract_results): (significant clusters, significant betas, all observed betas,
+    n clusters, (min, max, mean) beta, stats), or None if its maps are missing.
+    """
+    try:
+        # Read significant cluster map and the full beta maps
+        sign_clusters = load_map(os.path.join(mdir, ocn_name))
+        coef = load_map(os.path.join(mdir, coef_name))
+
+    except FileNotFoundError:
+        return None
+
+    # Cluster count, beta extremes and per-cluster statistics (precomputed in the term summary)
+    summary = term_summary(mdir, ocn_name, coef_name, sign_clusters, coef)
+    stats = dict(summary_stats(summary), summary=summary)
+
+    if summary['n_clusters'] == 0:  # all zeros = no significant clusters
+        betas = np.empty(sign_clusters.shape)
+        betas.fill(np.nan)
+        beta_range = (np.nan, np.nan, np.nan)
+    else:
+        # Set non-significant betas to NA (this is the only copy of the cached, read-only beta map)
+        betas = np.where(sign_clusters == 0, np.nan, coef)
+        beta_range = (summary['min_beta'], summary['max_beta'], summary['mean_beta'])
+
+    return sign_clusters, betas, coef, summary['n_clusters'], beta_range, stats
+
+
+def extract_results(which_model, which_term, which_meas, 
+                    resdir, resformat, return_stats=False):
+
+    files = result_files(which_model, which_term, which_meas, resdir, resformat)
 
     min_beta = []
     max_beta = []
     med_beta = []
     n_clusters = []
+    stats_left_right = {}
 
     sign_clusters_left_right = {}
     sign_betas_left_right = {}
@@ -245,22 +303,10 @@ def extract_results(which_model, which_term, which_meas,
 
     missing_hemis = []
 
-    for hemi in ['left', 'right']:
+    # Both hemispheres are read and summarised concurrently
+    for hemi, results in map_hemis(lambda hemi: hemi_results(*files[hemi])).items():
 
-        try:
-        # Read significant cluster map and the full beta maps
-            if resformat == 'QDECR':
-                mdir = os.path.join(resdir, group, f'{hemi[0]}h.{model}.{which_meas}')
-
-                ocn = nb.load(os.path.join(mdir, f'stack{which_term}.cache.th30.abs.sig.ocn.mgh'))
-                coef = nb.load(os.path.join(mdir, f'stack{which_term}.coef.mgh'))
-            
-            elif resformat == 'verywise':
-        
-                ocn = nb.load(os.path.join(mdir, f'{hemi[0]}h.{which_meas}.stack{which_term}.cache.th30.abs.sig.ocn.mgh'))
-                coef = nb.load(os.path.join(mdir, f'{hemi[0]}h.{which_meas}.stack{which_term}.coef.mgh'))
-        
-        except FileNotFoundError as e:
+        if results is None:
             missing_hemis.append(hemi)
             # Fill with NAs for this hemisphere
             sign_clusters_left_right[hemi] = np.array([])
@@ -270,129 +316,566 @@ def extract_results(which_model, which_term, which_meas,
             max_beta.append(np.nan)
             med_beta.append(np.nan)
             n_clusters.append(0)
+            stats_left_right[hemi] = cluster_stats(np.array([]), np.array([]))
             continue
 
-        sign_clusters = np.array(ocn.dataobj).flatten()
+        sign_clusters, betas, coef, hemi_n_clusters, (hemi_min, hemi_max, hemi_mean), stats = results
 
-        if not np.any(sign_clusters):  # all zeros = no significant clusters
-            betas = np.empty(sign_clusters.shape)
-            betas.fill(np.nan)
-            n_clusters.append(0)
-        else:
-            # Read beta map
-            betas = np.array(coef.dataobj).flatten()
-
-            # Set non-significant betas to NA
-            mask = np.where(sign_clusters == 0)[0]
-            betas[mask] = np.nan
-
-            n_clusters.append(np.max(sign_clusters))
-
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-
-            min_beta.append(np.nanmin(betas))
-            max_beta.append(np.nanmax(betas))
-            med_beta.append(np.nanmean(betas))
+        stats_left_right[hemi] = stats
+        n_clusters.append(hemi_n_clusters)
+        min_beta.append(hemi_min)
+        max_beta.append(hemi_max)
+        med_beta.append(hemi_mean)
 
         sign_clusters_left_right[hemi] = sign_clusters
         sign_betas_left_right[hemi] = betas
-        all_observed_betas_left_right[hemi] = np.array(coef.dataobj).flatten()
+        all_observed_betas_left_right[hemi] = coef
     
     if missing_hemis:
         raise FileNotFoundError(
             f'Could not find result files for the {" nor the ".join(missing_hemis)} hemisphere. '
             'Please check your results directory for missing or corrupted files.')
 
-    return np.nanmin(min_beta), np.nanmax(max_beta), np.nanmean(med_beta), n_clusters, \
-           sign_clusters_left_right, sign_betas_left_right, all_observed_betas_left_right
+    # Beta range over the hemispheres with clusters (NaN if neither has any). The missing values are dropped explicitly
+    # instead of silencing NumPy's all-NaN warnings: warning filters are process-wide, and results load concurrently.
+    def across_hemis(values, reduce):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        return reduce(values) if len(values) else np.nan
+
+    results = across_hemis(min_beta, np.min), across_hemis(max_beta, np.max), across_hemis(med_beta, np.mean), \
+        n_clusters, sign_clusters_left_right, sign_betas_left_right, all_observed_betas_left_right
+
+    if return_stats:
+        return results + (stats_left_right,)
+
+    return results
+
+
+def count_term_clusters(all_results, which_model, which_meas):
+    """
+    Number of significant clusters (both hemispheres) of each term of a model / measure, read from the term summaries
+    only (the maps are not loaded). Terms without a summary for both hemispheres are left out.
+    """
+    try:
+        terms = detect_terms(all_results, which_model, which_meas)
+    except (OSError, KeyError, IndexError):
+        return {}
+
+    counts = {}
+    for term, term_name in terms.items():
+        files = result_files(which_model, term, which_meas,
+                             all_results['results_directory'], all_results['results_format'])
+        summaries = [read_term_summary(mdir, coef_name, ocn_name) for mdir, ocn_name, coef_name in files.values()]
+        if all(summary is not None for summary in summaries):
+            counts[term_name] = sum(summary['n_clusters'] for summary in summaries)
+
+    return counts
 
 # ----------------------------------------------------------------------------------------------------------------------
 
 
-def calc_betainfo_bycluster(sign_clusters, sign_betas):
-    beta_by_clust = pd.DataFrame(columns=['hemi', 'size', 'mean', 'min', 'max'])
+def cluster_stats(sign_clusters, betas, coordinates=None):
+    """
+    Size, mean / min / max beta, peak vertex (largest absolute beta) and, if the vertex coordinates are given,
+    centroid of each cluster in a (hemisphere) cluster map. All statistics are computed in one pass over the
+    significant vertices, with bincount-style reductions over the integer cluster labels.
+    Returns a dict of arrays with one entry per (non-empty) cluster, plus the number of clusters in the map.
+    """
+    labels = np.asarray(sign_clusters).astype(np.int64)
+    vertices = np.flatnonzero(labels > 0)
+
+    lab = labels[vertices]
+    n = int(lab.max()) + 1 if len(lab) else 1
+    members = np.bincount(lab, minlength=n)
+
+    # Missing (non-finite) betas are left out of the beta statistics, as in a pandas groupby: a cluster whose betas are
+    # all missing keeps its row, with size 0, NaN statistics and no peak vertex (-1)
+    bts = np.asarray(betas)[vertices].astype(np.float64)
+    finite = np.isfinite(bts)
+    lab, beta_vertices, bts = lab[finite], vertices[finite], bts[finite]
+
+    size = np.bincount(lab, minlength=n)
+    total = np.bincount(lab, weights=bts, minlength=n)
+
+    mins = np.full(n, np.inf)
+    maxs = np.full(n, -np.inf)
+    np.minimum.at(mins, lab, bts)
+    np.maximum.at(maxs, lab, bts)
+
+    # Peak = first vertex (lowest index) with the largest absolute beta in the cluster
+    abs_bts = np.abs(bts)
+    peak_abs = np.full(n, -np.inf)
+    np.maximum.at(peak_abs, lab, abs_bts)
+    is_peak = abs_bts == peak_abs[lab]
+    peak_vertex = np.full(n, np.iinfo(np.int64).max)
+    np.minimum.at(peak_vertex, lab[is_peak], beta_vertices[is_peak])
+
+    present = np.flatnonzero(members[1:]) + 1
+    empty = size[present] == 0
+
+    peak_vertex = np.where(empty, -1, peak_vertex[present])
+    peak_beta = np.full(len(present), np.nan)
+    peak_beta[~empty] = np.asarray(betas)[peak_vertex[~empty]]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total[present] / size[present]
+
+    stats = dict(n_clusters=n - 1 if len(vertices) else 0,
+                 cluster=present,
+                 size=size[present],
+                 mean=mean,
+                 min=np.where(empty, np.nan, mins[present]),
+                 max=np.where(empty, np.nan, maxs[present]),
+                 peak_vertex=peak_vertex,
+                 peak_beta=peak_beta,
+                 centroid=None)
+
+    if coordinates is not None:
+        coords = np.asarray(coordinates)[vertices]
+        lab = labels[vertices]  # the centroid is over all the vertices of the cluster, with or without a beta
+        stats['centroid'] = np.column_stack([np.bincount(lab, weights=coords[:, d], minlength=n)[present]
+                                             for d in range(coords.shape[1])]) / members[present, None]
+    return stats
+
+
+def calc_betainfo_bycluster(sign_clusters, sign_betas, stats=None):
+    """
+    Table of the per-cluster statistics of both hemispheres (with an empty row before each hemisphere), for display.
+    stats ({hemi: cluster_stats}, e.g. from extract_results(..., return_stats=True)) avoids recomputing them.
+    """
+    import pandas as pd
+
+    if stats is None:
+        stats = map_hemis(lambda hemi: cluster_stats(sign_clusters[hemi], sign_betas[hemi]))
 
+    rows = []
     for hemi in ['left', 'right']:
 
-        cst = sign_clusters[
-            hemi].byteswap().newbyteorder()  # ensure that data aligns with the Sys architecture (avoid big-endian)
+        hemi_stats = stats[hemi]
 
-        if np.all(cst == 0):
+        if len(hemi_stats['cluster']) == 0:
             continue
 
-        bts = sign_betas[hemi].byteswap().newbyteorder()
+        rows.append(dict(cluster=''))
+        rows.extend(dict(cluster=f'Cluster {c}', hemi=hemi, size=float(hemi_stats['size'][i]),
+                         mean=hemi_stats['mean'][i], min=hemi_stats['min'][i], max=hemi_stats['max'][i],
+                         peak_vertex=hemi_stats['peak_vertex'][i])
+                    for i, c in enumerate(hemi_stats['cluster']))
+
+    return pd.DataFrame(rows, columns=['cluster', 'hemi', 'size', 'mean', 'min', 'max', 'peak_vertex'])
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Number of grid nodes the observed betas are binned onto before the density is estimated
+KDE_BINS = 2048
+
+# Densities already computed for a (map, term), so legends are not re-estimated every time they are re-rendered
+DENSITY_CACHE = ResultCache(max_bytes=16 * 1024 ** 2)
+
+
+def linear_binning(values, lo, hi, n_bins=KDE_BINS, weights=None):
+    """Spread each (weighted) value over its two neighbouring nodes of a regular grid (n_bins nodes from lo to hi)."""
+    dx = (hi - lo) / (n_bins - 1) if hi > lo else 1.
+    pos = np.clip((values - lo) / dx, 0, n_bins - 1)
+
+    left = np.minimum(pos.astype(np.int64), n_bins - 2) if n_bins > 1 else np.zeros(len(pos), dtype=np.int64)
+    w_right = pos - left
+    if weights is None:
+        weights = np.ones(len(pos))
+
+    return (np.bincount(left, weights=weights * (1 - w_right), minlength=n_bins) +
+            np.bincount(left + 1, weights=weights * w_right, minlength=n_bins)[:n_bins])
+
+
+def binned_gaussian_kde(counts, lo, hi, n_obs, std, grid):
+    """
+    Gaussian kernel density estimate evaluated at grid, from values pre-binned with linear_binning.
+    Uses the same bandwidth as scipy.stats.gaussian_kde (Scott's rule: std * n ** -1/5), but the kernel is convolved
+    with the binned counts (via FFT) instead of being evaluated for every (value, grid point) pair.
+    """
+    n_bins = len(counts)
+    bandwidth = std * n_obs ** (-1 / 5)
+
+    if n_obs < 2 or not bandwidth > 0:
+        return np.zeros(len(grid))
 
-        # Create a DataFrame from the arrays and filter only significant values
-        df = pd.DataFrame({'cluster': cst, 'beta': bts})
-        df = df[df['cluster'] > 0]
+    dx = (hi - lo) / (n_bins - 1) if hi > lo else bandwidth / 4
+    half_width = int(np.ceil(4 * bandwidth / dx))  # the kernel is truncated at 4 bandwidths
 
-        # Group by cluster and calculate mean and range for beta
-        hemi_beta_by_clust = df.groupby('cluster')['beta'].agg(
-            ['count', 'mean', 'min', 'max'])  # lambda x: x.max() - x.min()])
-        hemi_beta_by_clust.columns = ['size', 'mean', 'min', 'max']
-        hemi_beta_by_clust.insert(0, 'hemi', hemi)
+    offsets = np.arange(-half_width, half_width + 1) * dx
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2) / (np.sqrt(2 * np.pi) * bandwidth * n_obs)
 
-        beta_by_clust = pd.concat([beta_by_clust, pd.Series([np.nan]), hemi_beta_by_clust])
+    from scipy.signal import fftconvolve
 
-    beta_by_clust = beta_by_clust.reset_index()
+    density = np.maximum(fftconvolve(counts, kernel, mode='full'), 0)  # covers lo - half_width to hi + half_width
+    nodes = lo + (np.arange(len(density)) - half_width) * dx
 
-    beta_by_clust.insert(0, 'cluster', ['' if x == 0 else f'Cluster {int(x)}' for x in beta_by_clust['index']])
+    return np.interp(grid, nodes, density, left=0, right=0)
 
-    return beta_by_clust.drop(['index', 0], axis=1)
+
+def beta_density(obs_betas, grid, n_bins=KDE_BINS):
+    """Density of the observed beta values at each grid point (see binned_gaussian_kde)."""
+    obs_betas = obs_betas[np.isfinite(obs_betas)].astype(np.float64)
+
+    if len(obs_betas) == 0:
+        return np.zeros(len(grid))
+
+    lo, hi = obs_betas.min(), obs_betas.max()
+    counts = linear_binning(obs_betas, lo, hi, n_bins)
+    std = np.std(obs_betas, ddof=1) if len(obs_betas) > 1 else 0.
+
+    return binned_gaussian_kde(counts, lo, hi, len(obs_betas), std, grid)
 
 # ----------------------------------------------------------------------------------------------------------------------
 
+# Number of bins of the (per hemisphere) density histograms stored in the term summaries
+SUMMARY_BINS = 512
 
-def compute_overlap(model1, term1, measure1, model2, term2, measure2, 
-                    resdir, resformat):
 
-    sign_clusters1 = extract_results(model1, term1, measure1, resdir, resformat)[4]
-    sign_clusters2 = extract_results(model2, term2, measure2, resdir, resformat)[4]
+def summarise_term(sign_clusters, coef, stats=None):
+    """
+    JSON-serialisable summary of one term (hemisphere): cluster count, significant beta range, per-cluster statistics,
+    the range of all observed betas and a binned histogram of the non-zero ones (the betas shown in the legend).
+    """
+    if stats is None:
+        stats = cluster_stats(sign_clusters, coef)
+
+    summary = dict(n_clusters=stats['n_clusters'], min_beta=None, max_beta=None, mean_beta=None, clusters=[])
+
+    if len(stats['cluster']):
+        with_betas = stats['size'] > 0  # (clusters without any finite beta have NaN statistics)
+        if with_betas.any():
+            summary.update(min_beta=float(np.min(stats['min'][with_betas])),
+                           max_beta=float(np.max(stats['max'][with_betas])),
+                           mean_beta=float(np.sum(stats['mean'][with_betas] * stats['size'][with_betas]) /
+                                           np.sum(stats['size'])))
+        else:
+            summary.update(min_beta=np.nan, max_beta=np.nan, mean_beta=np.nan)
+
+        summary['clusters'] = [dict(cluster=int(c), size=int(stats['size'][i]), mean=float(stats['mean'][i]),
+                                    min=float(stats['min'][i]), max=float(stats['max'][i]),
+                                    peak_vertex=int(stats['peak_vertex'][i]), peak_beta=float(stats['peak_beta'][i]))
+                               for i, c in enumerate(stats['cluster'])]
+
+    obs_betas = np.asarray(coef, dtype=np.float64)
+    obs_betas = obs_betas[np.isfinite(obs_betas)]
+    summary['obs_range'] = [float(obs_betas.min()), float(obs_betas.max())] if len(obs_betas) else None
+
+    obs_betas = obs_betas[obs_betas != 0]
+    if len(obs_betas):
+        lo, hi = float(obs_betas.min()), float(obs_betas.max())
+        counts = linear_binning(obs_betas, lo, hi, SUMMARY_BINS)
+        summary['density'] = dict(n=len(obs_betas), mean=float(np.mean(obs_betas)),
+                                  std=float(np.std(obs_betas, ddof=1)) if len(obs_betas) > 1 else 0.,
+                                  lo=lo, hi=hi, counts=np.round(counts, 1).tolist())
+    else:
+        summary['density'] = None
 
-    ovlp_maps = {}
-    ovlp_info = {}
+    return summary
 
-    for hemi in ['left', 'right']:
-        sign1, sign2 = sign_clusters1[hemi], sign_clusters2[hemi]
 
-        sign1[sign1 > 0] = 1
-        sign2[sign2 > 0] = 2
+def summary_stats(summary):
+    """Per-cluster statistics of a term summary, in the same format as cluster_stats."""
+    clusters = summary['clusters']
+    stats = {key: np.array([c[key] for c in clusters], dtype=np.int64 if key in ('cluster', 'size') else np.float64)
+             for key in ('cluster', 'size', 'mean', 'min', 'max')}
+    # (not stored in summaries written by older versions)
+    stats['peak_vertex'] = np.array([c.get('peak_vertex', -1) for c in clusters], dtype=np.int64)
+    stats['peak_beta'] = np.array([c.get('peak_beta', np.nan) for c in clusters], dtype=np.float64)
+    stats.update(n_clusters=summary['n_clusters'], centroid=None)
+
+    return stats
+
+
+def summary_density(summaries, grid, n_bins=KDE_BINS):
+    """
+    Density of the observed betas of one or more term summaries (e.g. both hemispheres) at each grid point, from their
+    binned histograms (so the maps are not needed). Same estimator as beta_density. None if a histogram is missing.
+    """
+    densities = [s.get('density') for s in summaries]
+    if any(d is None for d in densities):
+        return None
+
+    n = sum(d['n'] for d in densities)
+    mean = sum(d['n'] * d['mean'] for d in densities) / n
+    var = sum((d['n'] - 1) * d['std'] ** 2 + d['n'] * (d['mean'] - mean) ** 2 for d in densities) / max(n - 1, 1)
+
+    # Re-bin the histograms onto one grid spanning all of them
+    lo, hi = min(d['lo'] for d in densities), max(d['hi'] for d in densities)
+    counts = sum(linear_binning(np.linspace(d['lo'], d['hi'], len(d['counts'])), lo, hi, n_bins,
+                                weights=np.asarray(d['counts'])) for d in densities)
+
+    return binned_gaussian_kde(counts, lo, hi, n, np.sqrt(var), grid)
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+# ===== SIGNIFICANCE MASK INDEX ========================================================================================
+# The significance masks of all terms of a model / measure in one bit-packed matrix per hemisphere (vertices x terms,
+# np.packbits along the terms: 100 terms of fsaverage take 2 MB instead of 65 MB of float maps), built from the
+# cluster (ocn) maps once and stored in the sidecar directory of the maps (see backend_io). The overlap tab (and other
+# queries across terms) then only read these bits.
+
+# Significant vertices of a map, packed 8 per byte
+PackedMask = namedtuple('PackedMask', ['bits', 'n_vertices'])
 
-        # Create maps
-        ovlp_maps[hemi] = np.sum([sign1, sign2], axis=0)
+# Indexes kept in memory per process (one per model / measure / hemisphere, replaced when their maps change)
+MASK_INDEX_CACHE_ENTRIES = 64
 
-        # Extract info
-        uniques, counts = np.unique(ovlp_maps[hemi], return_counts=True)
-        ovlp_info[hemi] = dict(zip(uniques, counts))
-        ovlp_info[hemi].pop(0)  # only significant clusters
+_MASK_INDEXES = SidecarCache(max_entries=MASK_INDEX_CACHE_ENTRIES)
 
-    # Merge left and right info
-    info = {k: [ovlp_info['left'].get(k, 0) + ovlp_info['right'].get(k, 0)] for k in
-            set(ovlp_info['left']) | set(ovlp_info['right'])}
-    percent = [round(i[0] / sum(sum(info.values(), [])) * 100, 1) for i in info.values()]
+# Bits (most significant first, as in np.packbits) of each byte value
+_BYTE_BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1)
+
+
+@functools.lru_cache(maxsize=1024)
+def _packed_mask(path, signature):
+    clusters = load_map(path)
+    bits = np.packbits(clusters > 0)
+    bits.setflags(write=False)
+    return PackedMask(bits, len(clusters))
+
+
+class SignificanceIndex:
+    """Bit-packed significance masks of the terms of one model / measure: {hemi: uint8 (vertices, terms / 8)}."""
+
+    def __init__(self, terms, bits):
+        self.terms = list(terms)
+        self.bits = bits
+
+    def column(self, term):
+        """Column of a term (given as in detect_terms, or as the string the UI selections hold)."""
+        return [str(t) for t in self.terms].index(str(term))
+
+    def mask(self, term):
+        """{hemi: boolean mask} of the vertices where a term is significant."""
+        byte, bit = divmod(self.column(term), 8)
+        return {hemi: (bits[:, byte] >> (7 - bit)) & 1 == 1 for hemi, bits in self.bits.items()}
+
+    def counts(self):
+        """{term: number of significant vertices (both hemispheres)}, from the byte value counts of each column."""
+        counts = np.zeros(len(self.terms), dtype=np.int64)
+        for bits in self.bits.values():
+            for byte in range(bits.shape[1]):
+                per_bit = np.bincount(bits[:, byte], minlength=256) @ _BYTE_BITS
+                counts[byte * 8:(byte + 1) * 8] += per_bit[:len(self.terms) - byte * 8]
+        return dict(zip(self.terms, counts.tolist()))
+
+
+def significance_index(all_results, which_model, which_meas):
+    """
+    SignificanceIndex of all terms of a model / measure (see detect_models), read from the stored index when it is
+    up to date, and otherwise built from the cluster maps (and stored).
+    """
+    resdir, resformat = all_results['results_directory'], all_results['results_format']
+    terms = list(detect_terms(all_results, which_model, which_meas))
+    files = [result_files(which_model, term, which_meas, resdir, resformat) for term in terms]
+    if not terms:
+        return SignificanceIndex(terms, {})
+
+    def hemi_bits(hemi):
+        paths = [os.path.join(*term_files[hemi][:2]) for term_files in files]
+        source = [map_signature(path) for path in paths]
+        index_path = mask_index_path(files[0][hemi][0], hemi, which_meas)
+        signature = json.dumps([[str(t) for t in terms], source])
+
+        stored = _MASK_INDEXES.get(index_path, signature)
+        if stored is None:
+            stored = read_mask_index(index_path, [str(t) for t in terms], source)
+            if stored is None:
+                masks = [_packed_mask(path, tuple(map_source or ())) for path, map_source in zip(paths, source)]
+                columns = np.stack([np.unpackbits(m.bits, count=m.n_vertices) for m in masks], axis=1)
+                stored = np.packbits(columns, axis=1)
+                write_mask_index(index_path, stored, [str(t) for t in terms], source)
+            stored.setflags(write=False)
+
+        return _MASK_INDEXES.put(index_path, signature, stored)
+
+    return SignificanceIndex(terms, map_hemis(hemi_bits))
+
+
+# ===== OVERLAP ========================================================================================================
+# Overlap of the significant clusters of any number of terms, from the significance mask indexes of their models (so
+# the maps are only read the first time a model / measure is indexed). Each vertex gets a combination label with bit i
+# set if term i is significant there (so with two terms: 1 = first only, 2 = second only, 3 = both). The labels are
+# (at most) 64-bit integers, so up to MAX_OVERLAP_TERMS terms can be compared at once.
+
+MAX_OVERLAP_TERMS = 63
+
+
+def overlap_labels(masks):
+    """Combination label of each vertex (bit i set if it is in mask i), from boolean masks of the same length."""
+    if len(masks) > MAX_OVERLAP_TERMS:
+        raise ValueError(f'Cannot compute the overlap of more than {MAX_OVERLAP_TERMS} terms at once '
+                         f'({len(masks)} were selected).')
+    dtype = np.uint8 if len(masks) <= 8 else np.uint16 if len(masks) <= 16 else np.int64
+    labels = np.zeros(len(masks[0]), dtype=dtype)
+    for i, mask in enumerate(masks):
+        labels |= mask.astype(dtype) << dtype(i)
+    return labels
+
+
+def compute_overlaps(terms, all_results):
+    """
+    Overlap of the significant clusters of N terms (a list of (model, term, measure), see detect_models).
+    Returns a dict with:
+        labels: {hemi: combination label of each vertex (bit i set if term i is significant)}
+        counts: {combination label: number of significant vertices (both hemispheres)}, without label 0
+        sizes: number of significant vertices of each term
+        pairs: {(i, j): dict(intersection, union, dice, jaccard)} for each pair of terms (i < j)
+    """
+    indexes = {}
+    masks = []
+    for model, term, meas in terms:
+        if (model, meas) not in indexes:
+            indexes[(model, meas)] = significance_index(all_results, model, meas)
+        masks.append(indexes[(model, meas)].mask(term))
+
+    labels = map_hemis(lambda hemi: overlap_labels([mask[hemi] for mask in masks]))
+
+    all_labels = np.concatenate([labels['left'], labels['right']])
+    if len(terms) <= 16:
+        counts = {label: int(n) for label, n in enumerate(np.bincount(all_labels)) if n}
+    else:  # too many combinations for a dense count
+        counts = {int(label): int(n) for label, n in zip(*np.unique(all_labels, return_counts=True))}
+    counts.pop(0, None)  # only significant vertices
+
+    def n_vertices(i, j, combine):
+        return sum(int(np.count_nonzero(combine(masks[i][hemi], masks[j][hemi]))) for hemi in ['left', 'right'])
+
+    sizes = [sum(int(np.count_nonzero(mask[hemi])) for hemi in ['left', 'right']) for mask in masks]
+    pairs = {}
+    for i in range(len(terms)):
+        for j in range(i + 1, len(terms)):
+            intersection, union = n_vertices(i, j, np.logical_and), n_vertices(i, j, np.logical_or)
+            pairs[(i, j)] = dict(intersection=intersection, union=union,
+                                 dice=2 * intersection / (sizes[i] + sizes[j]) if union else np.nan,
+                                 jaccard=intersection / union if union else np.nan)
+
+    return dict(labels=labels, counts=counts, sizes=sizes, pairs=pairs)
+
+
+def pairwise_overlap_table(overlap, names):
+    """Table of the overlap of each pair of terms (from compute_overlaps), with the given names of the terms."""
+    import pandas as pd
+
+    return pd.DataFrame([dict(term1=names[i], term2=names[j], size1=overlap['sizes'][i], size2=overlap['sizes'][j],
+                              **pair) for (i, j), pair in overlap['pairs'].items()])
+
+
+def compute_overlap(model1, term1, measure1, model2, term2, measure2, all_results):
+    """
+    Overlap of two terms: {label: [number of vertices, % of all significant vertices]} (1: unique to the first term,
+    2: unique to the second, 3: overlap) and the label maps of both hemispheres.
+    """
+    overlap = compute_overlaps([(model1, term1, measure1), (model2, term2, measure2)], all_results)
+
+    total = sum(overlap['counts'].values())
+    info = {label: [n, round(n / total * 100, 1)] for label, n in overlap['counts'].items()}
+
+    return info, overlap['labels']
+
+
+# ===== VERTEX QUERIES =================================================================================================
+# The beta and cluster id of all terms of a model / measure in one vertex-major float32 array per hemisphere (vertices
+# x terms x [beta, cluster id]), so that the values of one vertex across all terms are a single contiguous row. It is
+# built from the maps once, stored next to them (see backend_io) and memory-mapped, so querying a vertex reads a few
+# hundred bytes instead of every map of the model. Tables are only built when a vertex is first queried, with the maps
+# read past the result cache (they would otherwise evict the maps being shown).
+
+# Tables kept open per process (one per model / measure / hemisphere: memory-mapped, unless they could not be stored)
+VERTEX_TABLE_CACHE_ENTRIES = 16
+
+_VERTEX_TABLES = SidecarCache(max_entries=VERTEX_TABLE_CACHE_ENTRIES)
+_UNCACHED = ResultCache(max_bytes=0)
+
+
+def vertex_table(all_results, which_model, which_meas, hemi):
+    """
+    Vertex-major (vertices x terms x 2) table of the betas ([..., 0]) and cluster ids ([..., 1], 0: not significant)
+    of all terms of a model / measure (see detect_terms for the order of the terms). Missing maps are NaN.
+    """
+    resdir, resformat = all_results['results_directory'], all_results['results_format']
+    terms = list(detect_terms(all_results, which_model, which_meas))
+    if not terms:
+        return np.empty((0, 0, 2), dtype=np.float32)
+    files = [result_files(which_model, term, which_meas, resdir, resformat)[hemi] for term in terms]
+
+    paths = [(os.path.join(mdir, coef_name), os.path.join(mdir, ocn_name)) for mdir, ocn_name, coef_name in files]
+    source = [[map_signature(path) for path in term_paths] for term_paths in paths]
+    table_path = vertex_table_path(files[0][0], hemi, which_meas)
+    signature = json.dumps([[str(t) for t in terms], source])
+
+    table = _VERTEX_TABLES.get(table_path, signature)
+    if table is None:
+        table = read_vertex_table(table_path, [str(t) for t in terms], source)
+    if table is None:
+        for column, term_paths in enumerate(paths):
+            for field, path in enumerate(term_paths):
+                try:
+                    values = load_map(path, cache=_UNCACHED, shared_store=None)
+                except FileNotFoundError:
+                    continue
+                if table is None:
+                    table = np.full((len(values), len(terms), 2), np.nan, dtype=np.float32)
+                table[:, column, field] = values
+        if table is None:
+            raise FileNotFoundError(f'No maps of {which_model} ({which_meas}, {hemi} hemisphere) were found')
+        write_vertex_table(table_path, table, [str(t) for t in terms], source)
+        # Served from the stored file (memory-mapped) from now on, so the built copy is not kept in memory
+        stored = read_vertex_table(table_path, [str(t) for t in terms], source)
+        if stored is not None:
+            table = stored
+        table.setflags(write=False)
+
+    return _VERTEX_TABLES.put(table_path, signature, table)
+
+
+def vertex_tables(all_results, which_model):
+    """Build (or read) the vertex tables of every measure of a model (both hemispheres), e.g. ahead of a query."""
+    group, model = which_model.split('/')
+    group_df = all_results['results'][group]
+
+    for meas in sorted(group_df.loc[group_df.model == model, 'meas'].unique()):
+        map_hemis(lambda hemi: vertex_table(all_results, which_model, meas, hemi))
+
+
+def query_vertex(all_results, which_model, hemi, vertex):
+    """
+    Beta and cluster id (0: not significant) of one vertex for every term and measure of a model, as a DataFrame
+    (measure, stack, term, beta, cluster). Vertex numbers of the lower fsaverage resolutions are those of fsaverage.
+    """
+    import pandas as pd
+
+    group, model = which_model.split('/')
+    group_df = all_results['results'][group]
 
-    for i, k in enumerate(info.keys()):
-        info[k].append(percent[i])
+    rows = []
+    for meas in sorted(group_df.loc[group_df.model == model, 'meas'].unique()):
+        terms = detect_terms(all_results, which_model, meas)
+        values = vertex_table(all_results, which_model, meas, hemi)[vertex]
+        for (term, term_name), (beta, cluster) in zip(terms.items(), values.tolist()):
+            rows.append(dict(measure=meas, stack=term, term=term_name, beta=beta,
+                             cluster=0 if np.isnan(cluster) else int(cluster)))
 
-    return info, ovlp_maps
+    return pd.DataFrame(rows, columns=['measure', 'stack', 'term', 'beta', 'cluster'])
 
 
 # ===== PLOTTING FUNCTIONS ===================================================================
 
 def fetch_surface(resolution):
-    # Size / number of nodes per map
-    n_nodes = {'fsaverage': 163842,
-               'fsaverage6': 40962,
-               'fsaverage5': 10242}
+    # Meshes are loaded once per process (see backend_surfaces), not on every call
+    fs_avg = FsaverageSurfaces(resolution)
 
-    return datasets.fetch_surf_fsaverage(mesh=resolution), n_nodes[resolution]
+    return fs_avg, fs_avg.n_nodes
 
 
 def fetch_cont_colormap(stats_map,
                         max_val = 1,
                         min_val = -1, 
                         colorblind = True):
+    import matplotlib as mpl
 
     if max_val < 0 and min_val < 0:  # all negative associations
         thresh = max_val
@@ -432,6 +915,8 @@ def fetch_cont_colormap(stats_map,
 
 
 def fetch_discr_colormap(hemi, n_clusters, tot_clusters):
+    import matplotlib as mpl
+    from matplotlib.colors import ListedColormap
 
     mpl_cmap = styles.CLUSTER_COLORMAP
 
@@ -1,56 +1,234 @@
+import os
+import functools
 import numpy as np
 
-from nilearn import plotting
-from matplotlib.colors import ListedColormap
-
 from definitions.backend_calculations import fetch_surface, fetch_cont_colormap, fetch_discr_colormap
+from definitions.backend_surfaces import ICO_ORDER, N_NODES, get_lod_surface, ico_nodes, downsample_map
+from definitions.backend_io import map_hemis
 import definitions.layout_styles as styles
 
+# ===== PLOTLY BRAIN MESHES ====================================================================
+# Lightweight replacement for nilearn.plotting.plot_surf(engine='plotly'): the mesh coordinates and faces are
+# prepared once per (surface, resolution, hemisphere) and only the vertex colors are computed on each update.
+# matplotlib and plotly are imported on first use, so that importing this module (e.g. by app.py) stays cheap.
 
-def plot_surfmap(min_beta, max_beta, n_clusters, sign_clusters, sign_betas,
-                 surf='pial',  # 'pial', 'infl', 'flat', 'sphere'
-                 resol='fsaverage6',
-                 output='betas',
-                 colorblind=False):
+AXIS_CONFIG = dict(showgrid=False, showline=False, ticks='', title='', showticklabels=False, zeroline=False,
+                   showspikes=False, spikesides=False, showbackground=False)
+
+BRAIN_LAYOUT = dict(scene=dict(dragmode='orbit', xaxis=AXIS_CONFIG, yaxis=AXIS_CONFIG, zaxis=AXIS_CONFIG),
+                    paper_bgcolor='#fff', hovermode=False, margin=dict(l=0, r=0, b=0, t=0, pad=0))
+
+CAMERAS = {'left': dict(eye=dict(x=-1.5, y=0, z=0), up=dict(x=0, y=0, z=1), center=dict(x=0, y=0, z=0)),
+           'right': dict(eye=dict(x=1.5, y=0, z=0), up=dict(x=0, y=0, z=1), center=dict(x=0, y=0, z=0)),
+           'dorsal': dict(eye=dict(x=0, y=0, z=1.5), up=dict(x=-1, y=0, z=0), center=dict(x=0, y=0, z=0)),
+           'ventral': dict(eye=dict(x=0, y=0, z=-1.5), up=dict(x=1, y=0, z=0), center=dict(x=0, y=0, z=0)),
+           'anterior': dict(eye=dict(x=0, y=1.5, z=0), up=dict(x=0, y=0, z=1), center=dict(x=0, y=0, z=0)),
+           'posterior': dict(eye=dict(x=0, y=-1.5, z=0), up=dict(x=0, y=0, z=1), center=dict(x=0, y=0, z=0))}
+
+# Vertex colors are computed as indices (uint8) into a palette of colormap colors followed by background greys, and
+# sent to the browser as the palette color of each vertex (see brain_figure)
+PALETTE_SIZE = 256
+N_GREYS = 64
+
+# Level of detail: meshes finer than the preview order (icosahedron order, 5: 10k vertices) are first shown decimated
+# to it, and refined once the preview is displayed. Resolution 'auto' picks the finest mesh the browser is expected to
+# build within LOD_BUDGET_MS, from a benchmark it runs on connection (see CLIENT_BENCHMARK_JS).
+LOD_PREVIEW_ORDER = int(os.environ.get('VWW_LOD_PREVIEW_ORDER', 5))
+LOD_BUDGET_MS = float(os.environ.get('VWW_LOD_BUDGET_MS', 1500))
+LOD_VERTEX_COST = 2000  # browser time to build and draw one mesh vertex, relative to one vertex of the benchmark
+AUTO_DEFAULT_RESOLUTION = 'fsaverage6'  # without a benchmark result
+LOD_REFINE_DELAY = 1.0  # seconds a preview is shown before it is refined
+
+CLIENT_BENCHMARK_JS = """
+$(document).on('shiny:connected', function() {
+    var n = 100000, repeats = 10, a = new Float32Array(3 * n), s = 0, t0 = performance.now();
+    for (var r = 0; r < repeats; r++) {
+        for (var i = 0; i < 3 * n; i++) { a[i] = Math.sqrt(i + r) * 0.5; s += a[i]; }
+    }
+    Shiny.setInputValue('client_benchmark', {ms_per_vertex: (performance.now() - t0) / (repeats * n),
+                                             cores: navigator.hardwareConcurrency || 1, checksum: s});
+});
+"""
+
+
+def camera_view(hemi, view='lateral'):
+    if view == 'lateral':
+        return CAMERAS[hemi]
+    if view == 'medial':
+        return CAMERAS['right' if hemi == 'left' else 'left']
+    return CAMERAS[view]
+
+
+def preview_order(resol):
+    """Icosahedron order of the preview mesh of a resolution, None if it is coarse enough to be shown directly."""
+    return LOD_PREVIEW_ORDER if ICO_ORDER[resol] > LOD_PREVIEW_ORDER else None
+
+
+def auto_resolution(client_benchmark=None, budget_ms=LOD_BUDGET_MS):
+    """Finest resolution whose mesh the browser is expected to build within budget_ms (see CLIENT_BENCHMARK_JS)."""
+    if not client_benchmark or not client_benchmark.get('ms_per_vertex'):
+        return AUTO_DEFAULT_RESOLUTION
+
+    ms_per_vertex = client_benchmark['ms_per_vertex'] * LOD_VERTEX_COST
+    fitting = [resol for resol, n_nodes in N_NODES.items() if n_nodes * ms_per_vertex <= budget_ms]
+
+    return max(fitting, key=N_NODES.get) if fitting else min(N_NODES, key=N_NODES.get)
+
+
+def lod_colors(vertex_index, order=None):
+    """Vertex colors on the order-k decimated mesh (its vertices come first)."""
+    return vertex_index if order is None else vertex_index[:ico_nodes(order)]
+
+
+@functools.lru_cache(maxsize=None)
+def brain_mesh(surf, resol, hemi, order=None):
+    """
+    Mesh3d geometry (x, y, z coordinates and i, j, k faces) of one hemisphere, computed once. With order, the mesh
+    is decimated to that icosahedron order (a level of detail).
+    """
+    if order is None:
+        fs_avg, _ = fetch_surface(resol)
+        coords, faces = fs_avg[f'{surf}_{hemi}']
+    else:
+        coords, faces = get_lod_surface(resol, f'{surf}_{hemi}', order)
+
+    return dict(x=coords[:, 0], y=coords[:, 1], z=coords[:, 2],
+                i=faces[:, 0], j=faces[:, 1], k=faces[:, 2])
+
+
+def to_hex(colors):
+    colors = np.asarray(colors[:, :3] * 255, dtype='uint8')
+    return [f'#{r:02x}{g:02x}{b:02x}' for r, g, b in colors]
+
+
+def vertex_colors(stats_map, bg_map=None, cmap='viridis', vmin=None, vmax=None, threshold=None,
+                  symmetric_cmap=False, darkness=0.7, n_colors=PALETTE_SIZE - N_GREYS):
+    """
+    Color the vertices of a map the way nilearn does (plotly engine), but with a vectorised colormap lookup.
+    Vertices with a value above threshold take the color of that value, the others (and NAs) show the background
+    (e.g. sulcal depth) map in grey.
+    Returns a palette of (at most PALETTE_SIZE) hex colors and the palette index (uint8) of each vertex.
+    """
+    import matplotlib as mpl
+    from matplotlib.colors import Normalize
+
+    cmap = mpl.colormaps[cmap] if isinstance(cmap, str) else cmap
+    values = np.asarray(stats_map, dtype=float)
+
+    if vmax is None:
+        vmax = np.nanmax(np.abs(values))
+    vmax = float(vmax)
+    if symmetric_cmap:
+        vmin = -vmax
+    if vmin is None:
+        vmin = np.nanmin(values)
+    norm = Normalize(vmin=vmin, vmax=vmax)
+
+    # Colormap lookup table (sampled at n_colors levels, with the values within the threshold in grey)
+    n_colors = min(n_colors, cmap.N)
+    lut = cmap(np.arange(cmap.N)) if n_colors == cmap.N else cmap((np.arange(n_colors) + 0.5) / n_colors)
+    if threshold is not None:
+        istart = int(norm(-threshold, clip=True) * (n_colors - 1))
+        istop = int(norm(threshold, clip=True) * (n_colors - 1))
+        lut[istart:istop] = (0.5, 0.5, 0.5, 1.)
+
+    shown = ~np.isnan(values)
+    if threshold is not None:
+        shown &= ~(np.abs(values) < threshold)
 
-    fs_avg, n_nodes = fetch_surface(resol)
+    scaled = np.asarray(norm(np.where(shown, values, vmin)), dtype=float) * n_colors
+    color_index = np.clip(scaled, 0, n_colors - 1).astype(np.uint8)
 
-    brain3D = {}
+    # Background: rescaled to [0, 1] (if needed), darkened and colored on a grey scale
+    bg_data = np.full(values.shape, 0.5) if bg_map is None else np.array(bg_map, dtype=float)
+    bg_min, bg_max = np.min(bg_data), np.max(bg_data)
+    if bg_min < 0 or bg_max > 1:
+        bg_data = (bg_data - bg_min) / (bg_max - bg_min)
+    bg_top = 1. if darkness is None else darkness
 
-    # If no cluster are identified, return empty brain
-    if n_clusters[0] == n_clusters[1] == 0:
-        for hemi in ['left', 'right']:
-            brain3D[hemi] = plotting.plot_surf(
-                surf_mesh=fs_avg[f'{surf}_{hemi}'],  # Surface mesh geometry
-                surf_map=None,  # No statistical map
-                bg_map=fs_avg[f'sulc_{hemi}'],  # alpha=.2, only in matplotlib
-                darkness=0.3,
-                hemi=hemi,
-                view='lateral',
-                engine='plotly',  # axes=axs[0] # only for matplotlib
-                symmetric_cmap=True,
-                colorbar=False).figure
-        return brain3D
+    n_greys = PALETTE_SIZE - n_colors
+    bg_index = np.round(bg_data * (n_greys - 1)).astype(np.uint8)
 
+    palette = to_hex(lut) + to_hex(mpl.colormaps['Greys'](np.linspace(0, bg_top, n_greys)))
+    vertex_index = np.where(shown, color_index, n_colors + bg_index).astype(np.uint8)
 
-    for nh, hemi in enumerate(['left', 'right']):
+    return palette, vertex_index
 
+
+def palette_vertexcolor(palette, vertex_index):
+    """Hex color of each vertex (Mesh3d vertexcolor) from the palette and the palette index of each vertex."""
+    return np.asarray(palette)[vertex_index]
+
+
+def brain_figure(surf, resol, hemi, palette, vertex_index, view='lateral', widget=False, order=None,
+                 clickable=False):
+    """
+    Plotly figure (or FigureWidget) of one hemisphere, re-using the (cached) mesh geometry. Vertex colors are sent
+    as the palette color of each vertex (vertexcolor, blended across the faces like nilearn does), so they can be
+    updated without re-sending the mesh. They are not sent as palette indices with a colorscale: the browser would
+    interpolate the indices, and faces between e.g. a cluster and the background would show unrelated palette colors.
+    With order, the mesh is shown at a lower level of detail (see brain_mesh). With clickable, the browser picks the
+    vertex under the mouse (without hover labels), so that clicks can be handled (the point number is the vertex).
+    """
+    import plotly.graph_objects as go
+
+    mesh = go.Mesh3d(**brain_mesh(surf, resol, hemi, order),
+                     vertexcolor=palette_vertexcolor(palette, lod_colors(vertex_index, order)),
+                     hoverinfo='none')
+
+    fig = go.FigureWidget(data=[mesh]) if widget else go.Figure(data=[mesh])
+    fig.update_layout(scene_camera=camera_view(hemi, view), **BRAIN_LAYOUT)
+    if clickable:
+        fig.update_layout(hovermode='closest')  # plotly only reports clicks on points it can hover
+
+    return fig
+
+
+def update_brain_colors(fig, palette, vertex_index):
+    """Patch the vertex colors of a brain figure (widget) in place: only the colors are sent to the browser."""
+    fig.data[0].vertexcolor = palette_vertexcolor(palette, vertex_index)
+
+
+def update_brain_mesh(fig, surf, resol, hemi, palette, vertex_index, order=None):
+    """Replace the mesh of a brain figure (widget) in place by another level of detail, keeping the camera."""
+    with fig.batch_update():
+        fig.data[0].update(**brain_mesh(surf, resol, hemi, order),
+                           vertexcolor=palette_vertexcolor(palette, lod_colors(vertex_index, order)))
+
+
+def empty_brain_colors(resol, hemi):
+    """Colors of a hemisphere without a statistical map: only the sulcal depth is shown (in lighter greys)."""
+    fs_avg, _ = fetch_surface(resol)
+    sulc = np.asarray(fs_avg[f'sulc_{hemi}'])
+    return vertex_colors(stats_map=np.full(sulc.shape, np.nan), bg_map=sulc, darkness=0.3, cmap='Greys',
+                         symmetric_cmap=True, vmin=-1, vmax=1)
+
+
+def empty_brain(surf, resol, hemi):
+    return brain_figure(surf, resol, hemi, *empty_brain_colors(resol, hemi))
+
+# ----------------------------------------------------------------------------------------------
+
+
+def surfmap_colors(min_beta, max_beta, n_clusters, sign_clusters, sign_betas,
+                   resol='fsaverage6',
+                   output='betas',
+                   colorblind=False,
+                   hemis=('left', 'right')):
+    """Vertex colors (palette and palette index of each vertex) of the left and right (or the given) hemisphere maps."""
+
+    fs_avg, _ = fetch_surface(resol)
+
+    def hemi_colors(hemi):
+        nh = ['left', 'right'].index(hemi)
+
+        # If no cluster are identified, return empty brain
         if n_clusters[nh] == 0:
-            brain3D[hemi] = plotting.plot_surf(
-                surf_mesh=fs_avg[f'{surf}_{hemi}'],  # Surface mesh geometry
-                surf_map=None,  # No statistical map
-                bg_map=fs_avg[f'sulc_{hemi}'],  # alpha=.2, only in matplotlib
-                darkness=0.3,
-                hemi=hemi,
-                view='lateral',
-                engine='plotly',  # axes=axs[0] # only for matplotlib
-                symmetric_cmap=True,
-                colorbar=False).figure
-
-            continue
+            return empty_brain_colors(resol, hemi)
 
         if output == 'clusters':
             stats_map = sign_clusters[hemi]
+            how = 'max'  # cluster labels
 
             max_val = n_clusters[nh]
             min_val = 1
@@ -65,6 +243,7 @@ def plot_surfmap(min_beta, max_beta, n_clusters, sign_clusters, sign_betas,
 
         else:
             stats_map = sign_betas[hemi]
+            how = 'mean'
 
             max_val = max_beta
             min_val = min_beta
@@ -74,53 +253,51 @@ def plot_surfmap(min_beta, max_beta, n_clusters, sign_clusters, sign_betas,
                                                min_val = min_val,
                                                colorblind = colorblind)
            
-        brain3D[hemi] = plotting.plot_surf(
-                surf_mesh=fs_avg[f'{surf}_{hemi}'],  # Surface mesh geometry
-                surf_map=stats_map[:n_nodes],  # Statistical map
-                bg_map=fs_avg[f'sulc_{hemi}'],  # alpha=.2, only in matplotlib
+        return vertex_colors(
+                stats_map=downsample_map(stats_map, resol, hemi, how=how),  # Statistical map
+                bg_map=fs_avg[f'sulc_{hemi}'],
                 darkness=0.6,
-                hemi=hemi,
-                view='lateral',
-                engine='plotly',  # axes=axs[0] # only for matplotlib
                 cmap=cmap,
                 symmetric_cmap=False,
-                colorbar=False,
                 vmin=min_val, vmax=max_val,
-                # cbar_vmin=min_val, cbar_vmax=max_val,
-                avg_method='median',
-                # title=f'{hemi} hemisphere',
-                # title_font_size=20,
-                threshold=thresh
-            ).figure
+                threshold=thresh)
+
+    # Both hemispheres are colored concurrently
+    return map_hemis(hemi_colors, [hemi for hemi in ['left', 'right'] if hemi in hemis])
+
+
+def plot_surfmap(min_beta, max_beta, n_clusters, sign_clusters, sign_betas,
+                 surf='pial',  # 'pial', 'infl', 'flat', 'sphere'
+                 resol='fsaverage6',
+                 output='betas',
+                 colorblind=False):
 
-    return brain3D
+    colors = surfmap_colors(min_beta, max_beta, n_clusters, sign_clusters, sign_betas,
+                            resol=resol, output=output, colorblind=colorblind)
+
+    return map_hemis(lambda hemi: brain_figure(surf, resol, hemi, *colors[hemi]))
 
 
 # ---------------------------------------------------------------------------------------------
 
 
 def plot_overlap(overlap_maps, surf='pial', resol='fsaverage6'):
+    from matplotlib.colors import ListedColormap
 
-    fs_avg, n_nodes = fetch_surface(resol)
+    fs_avg, _ = fetch_surface(resol)
 
     cmap = ListedColormap([styles.OVLP_COLOR1, styles.OVLP_COLOR2, styles.OVLP_COLOR3])
 
-    brain3D = {}
-
-    for hemi in ['left', 'right']:
-
-        brain3D[hemi] = plotting.plot_surf(
-            surf_mesh=fs_avg[f'{surf}_{hemi}'],  # Surface mesh geometry
-            surf_map=overlap_maps[hemi][:n_nodes],  # Statistical map
-            bg_map=fs_avg[f'sulc_{hemi}'],  # alpha=.2, only in matplotlib
+    def hemi_brain(hemi):
+        palette, vertex_index = vertex_colors(
+            stats_map=downsample_map(overlap_maps[hemi], resol, hemi, how='max'),  # Statistical map
+            bg_map=fs_avg[f'sulc_{hemi}'],
             darkness=0.7,
-            hemi=hemi,
-            view='lateral',
-            engine='plotly',  # or matplolib # axes=axs[0] # only for matplotlib
             cmap=cmap,
-            colorbar=False,
             vmin=1, vmax=3,
-            threshold=1
-        ).figure
+            threshold=1)
+
+        return brain_figure(surf, resol, hemi, palette, vertex_index)
 
-    return brain3D
+    # Both hemispheres are colored and built concurrently
+    return map_hemis(hemi_brain)
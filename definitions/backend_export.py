@@ -0,0 +1,126 @@
+import os
+import re
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+# ===== BATCH EXPORT ===================================================================================================
+# Headless export of the static figure (plot_brain_2d) and the cluster table of every model / measure / term in a
+# results directory, rendered in parallel by a pool of worker processes.
+# Usage: python -m definitions.backend_export <results_directory> <output_directory> [--format QDECR] [--workers 8]
+
+
+def list_terms(all_results):
+    """All (model, measure, term number, term name) combinations of a results directory (see detect_models)."""
+    from definitions.backend_calculations import detect_terms
+
+    terms = []
+    for group, group_df in sorted(all_results['results'].items()):
+        for model in sorted(group_df.model.unique()):
+            which_model = f'{group}/{model}'
+            for meas in sorted(group_df.loc[group_df.model == model, 'meas'].unique()):
+                for term, term_name in detect_terms(all_results, which_model, meas).items():
+                    terms.append((which_model, meas, term, term_name))
+    return terms
+
+
+def export_file_name(outdir, which_model, meas, term, extension):
+    group, model = which_model.split('/')
+    folder = os.path.join(outdir, *([group] if group == model else [group, model]))
+    return os.path.join(folder, f'{meas}.stack{term}.{extension}')
+
+
+def export_term(resdir, resformat, outdir, which_model, meas, term, term_name,
+                resol='fsaverage5', dpi=150, include_empty=False):
+    """Render the figure and write the cluster table of one term. Runs in a worker process."""
+    import matplotlib
+    matplotlib.use('Agg')  # no display in worker processes
+    import matplotlib.pyplot as plt
+
+    from definitions.backend_calculations import extract_results, calc_betainfo_bycluster
+    from definitions.backend_static_plots import plot_brain_2d
+
+    min_beta, max_beta, mean_beta, n_clusters, sign_clusters, sign_betas, all_betas, stats = extract_results(
+        which_model, term, meas, resdir, resformat, return_stats=True)
+
+    row = dict(model=which_model, measure=meas, stack=term, term=term_name,
+               n_clusters_left=int(n_clusters[0]), n_clusters_right=int(n_clusters[1]),
+               min_beta=min_beta, max_beta=max_beta, mean_beta=mean_beta, figure=None, table=None)
+
+    if sum(n_clusters) == 0 and not include_empty:
+        return row
+
+    os.makedirs(os.path.dirname(export_file_name(outdir, which_model, meas, term, 'png')), exist_ok=True)
+
+    row['table'] = export_file_name(outdir, which_model, meas, term, 'csv')
+    table = calc_betainfo_bycluster(sign_clusters, sign_betas, stats=stats)
+    table[table['cluster'] != ''].to_csv(row['table'], index=False)  # without the (empty) spacer rows
+
+    fig = plot_brain_2d(sign_betas, all_betas, model=which_model.split('/')[1], meas=meas, resol=resol,
+                        title=f'{which_model.split("/")[1]} ({meas}): {term_name}', dpi=dpi)
+    row['figure'] = export_file_name(outdir, which_model, meas, term, 'png')
+    fig.savefig(row['figure'], dpi=dpi)
+    plt.close(fig)
+
+    return row
+
+
+def export_results_directory(resdir, outdir, resformat='verywise', resol='fsaverage5', dpi=150,
+                             include_empty=False, max_workers=None, pattern=None):
+    """
+    Export the figures and cluster tables of all terms in a results directory (optionally only the terms whose
+    '<model> <measure> <term name>' matches the regular expression pattern). Also writes an overview of all terms
+    (summary.csv). Returns the overview as a DataFrame.
+    """
+    from definitions.backend_calculations import detect_models
+
+    all_results = detect_models(resdir, results_format=resformat)
+    resdir = str(all_results['results_directory'])  # i.e. the local copy of remote results
+
+    terms = list_terms(all_results)
+    if pattern is not None:
+        terms = [t for t in terms if re.search(pattern, f'{t[0]} {t[1]} {t[3]}')]
+
+    os.makedirs(outdir, exist_ok=True)
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(export_term, resdir, resformat, outdir, which_model, meas, term, term_name,
+                               resol=resol, dpi=dpi, include_empty=include_empty): (which_model, meas, term_name)
+                   for which_model, meas, term, term_name in terms}
+
+        for e, future in enumerate(as_completed(futures)):
+            which_model, meas, term_name = futures[future]
+            try:
+                rows.append(future.result())
+                status = 'done' if rows[-1]['figure'] else 'no clusters'
+            except Exception as error:  # e.g. missing maps for one hemisphere: keep exporting the other terms
+                status = f'failed ({error})'
+            print(f'[{e + 1}/{len(terms)}] {which_model} {meas} {term_name}: {status}', flush=True)
+
+    overview = pd.DataFrame(rows)
+    if len(overview):
+        overview = overview.sort_values(['model', 'measure', 'stack'])
+    overview.to_csv(os.path.join(outdir, 'summary.csv'), index=False)
+
+    return overview
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the figures and cluster tables of all terms in a results '
+                                                 'directory.')
+    parser.add_argument('resdir', help='Results directory (or GitHub folder / archive, as in the app)')
+    parser.add_argument('outdir', help='Output directory')
+    parser.add_argument('--format', default='verywise', choices=['verywise', 'QDECR'], help='Results format')
+    parser.add_argument('--resolution', default='fsaverage5', choices=['fsaverage5', 'fsaverage6', 'fsaverage'],
+                        help='Surface resolution of the figures')
+    parser.add_argument('--dpi', type=int, default=150, help='Resolution of the PNG figures')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: all CPUs)')
+    parser.add_argument('--include-empty', action='store_true', help='Also export terms without significant clusters')
+    parser.add_argument('--match', default=None,
+                        help='Only export terms whose "<model> <measure> <term name>" matches this regular expression')
+    args = parser.parse_args()
+
+    export_results_directory(args.resdir, args.outdir, resformat=args.format, resol=args.resolution, dpi=args.dpi,
+                             include_empty=args.include_empty, max_workers=args.workers, pattern=args.match)
@@ -0,0 +1,590 @@
+import io
+import os
+import re
+import json
+import hashlib
+import warnings
+import threading
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# ===== RESULT MAP CACHE ===============================================================================================
+
+# Upper bound (in MB) for the decoded maps kept in memory by each app worker process
+CACHE_SIZE_MB = float(os.environ.get('VWW_CACHE_SIZE_MB', 512))
+
+# Memory-map uncompressed .mgh files instead of decoding them into private copies (set to 0 to disable)
+MMAP_MAPS = os.environ.get('VWW_MMAP_MAPS', '1') != '0'
+
+
+class ResultCache:
+    """
+    Process-wide, size-bounded (in bytes) LRU cache for decoded result maps.
+    Entries are stored as read-only arrays, so they can be shared safely across all sessions of one worker.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key, array):
+        array.setflags(write=False)
+
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key).nbytes
+
+            # Arrays larger than the whole cache are returned but never stored
+            if array.nbytes > self.max_bytes:
+                return array
+
+            self._entries[key] = array
+            self.nbytes += array.nbytes
+
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+        return array
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(entries=len(self._entries), nbytes=self.nbytes, max_bytes=self.max_bytes,
+                        hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+RESULT_CACHE = ResultCache(max_bytes=CACHE_SIZE_MB * 1024 ** 2)
+
+# ===== SHARED (CROSS-WORKER) CACHE ====================================================================================
+# When several app workers run on one host, decoded maps (and surface meshes, see backend_surfaces) can be stored once
+# as .npy files in a shared cache directory (ideally on a RAM-backed file system such as /dev/shm) and memory-mapped
+# by all workers, so N workers hold one copy of each array. The first worker that needs an array creates it while
+# holding a lock on it, the others wait and then map the same file.
+
+SHARED_CACHE_DIR = os.environ.get('VWW_SHARED_CACHE_DIR')  # e.g. /dev/shm/vwwizard (unset: no shared cache)
+SHARED_CACHE_SIZE_MB = float(os.environ.get('VWW_SHARED_CACHE_SIZE_MB', 4096))
+
+
+@contextlib.contextmanager
+def file_lock(path, blocking=True):
+    """
+    Exclusive (advisory) lock on path + '.lock', shared by all processes on the host. Yields False if blocking=False
+    and another process holds the lock. Without fcntl (i.e. on Windows), nothing is locked: concurrent processes may
+    then do the same work twice, but files are always written atomically.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield True
+        return
+
+    with open(f'{path}.lock', 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def save_array(path, array):
+    """Write an array to a .npy file atomically (readers never see a half-written file)."""
+    tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+class SharedArrayStore:
+    """
+    Directory of memory-mapped .npy arrays shared by all processes on a host, bounded (approximately) to max_bytes.
+    Arrays are keyed on any repr-able key that identifies their content (e.g. path, mtime, size) and the least recently
+    used ones are removed when the directory grows too large (processes that still map them keep their copy).
+    Arrays are created under one lock per hash bucket (the first LOCK_BUCKET_CHARS hex digits of their file name):
+    lock files are never removed (a process could otherwise lock a new file while another one holds the old one), and
+    there are at most 16 ** LOCK_BUCKET_CHARS of them.
+    """
+
+    LOCK_BUCKET_CHARS = 2
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.npy')
+
+    def lock_path(self, path):
+        return os.path.join(self.directory, 'bucket-' + os.path.basename(path)[:self.LOCK_BUCKET_CHARS])
+
+    def _load(self, path):
+        try:
+            array = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):  # not there (yet), or removed while being read
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(path)  # mark as recently used
+        return array
+
+    def get_or_create(self, key, create):
+        """Return the shared (read-only, memory-mapped) array for key, creating it with create() if needed."""
+        path = self.path(key)
+
+        array = self._load(path)
+        if array is not None:
+            return array
+
+        with file_lock(self.lock_path(path)):
+            array = self._load(path)  # created by another process while we were waiting for the lock
+            if array is None:
+                save_array(path, np.ascontiguousarray(create()))
+                self.prune()
+                array = self._load(path)
+
+        return array
+
+    def prune(self):
+        """Remove the least recently used arrays until the store fits in max_bytes (skipped if already running)."""
+        with file_lock(os.path.join(self.directory, 'prune'), blocking=False) as locked:
+            if not locked:
+                return
+            entries = []
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith('.npy') and '.tmp' not in entry.name:
+                        with contextlib.suppress(OSError):
+                            st = entry.stat()
+                            entries.append((st.st_mtime_ns, st.st_size, entry.path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries)[:-1]:  # never remove the newest array
+                if total <= self.max_bytes:
+                    break
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+                total -= size
+
+
+SHARED_STORE = SharedArrayStore(SHARED_CACHE_DIR, SHARED_CACHE_SIZE_MB * 1024 ** 2) if SHARED_CACHE_DIR else None
+
+# ===== HEMISPHERE THREADS =============================================================================================
+# The two hemispheres are independent and most of their processing (map I/O, NumPy) releases the GIL, so the work of
+# each hemisphere runs concurrently in a pool of threads shared by the whole process. VWW_HEMI_WORKERS defaults to the
+# number of CPUs; below 2 (e.g. on a single CPU, where the threads only add overhead) the hemispheres are processed one
+# after the other, in the calling thread.
+
+HEMI_WORKERS = int(os.environ.get('VWW_HEMI_WORKERS', os.cpu_count() or 1))
+
+_HEMI_POOL = None
+_HEMI_POOL_LOCK = threading.Lock()
+_HEMI_THREAD = threading.local()
+
+
+def _hemi_task(function, hemi):
+    _HEMI_THREAD.active = True
+    try:
+        return function(hemi)
+    finally:
+        _HEMI_THREAD.active = False
+
+
+def map_hemis(function, hemis=('left', 'right')):
+    """
+    {hemi: function(hemi)} of each hemisphere, computed concurrently: the first in the calling thread, the others in
+    the shared pool. Nested calls (from a pool thread) run sequentially, so pool threads never wait for each other.
+    """
+    global _HEMI_POOL
+
+    if HEMI_WORKERS < 2 or len(hemis) < 2 or getattr(_HEMI_THREAD, 'active', False):
+        return {hemi: function(hemi) for hemi in hemis}
+
+    with _HEMI_POOL_LOCK:
+        if _HEMI_POOL is None:
+            _HEMI_POOL = ThreadPoolExecutor(max_workers=HEMI_WORKERS, thread_name_prefix='vwwizard-hemi')
+
+    futures = {hemi: _HEMI_POOL.submit(_hemi_task, function, hemi) for hemi in hemis[1:]}
+    results = {hemis[0]: function(hemis[0])}
+    results.update((hemi, future.result()) for hemi, future in futures.items())
+
+    return results
+
+# ===== MAP LOADING ====================================================================================================
+
+
+def read_mgh(path, mmap=MMAP_MAPS):
+    """
+    Read a (.mgh) surface map as a flat array.
+    With mmap=True, uncompressed files are memory-mapped (with their big-endian dtype) and returned as read-only
+    views, so the data lives in the OS page cache, which is shared between worker processes. Compressed (.mgz)
+    files, or maps that are not a single vector, are decoded into a copy with native byte order.
+    """
+    import nibabel as nb
+
+    img = nb.load(path)
+
+    if mmap and not path.endswith('.mgz') and sum(d > 1 for d in img.shape) <= 1:
+        return np.memmap(path, dtype=img.get_data_dtype(), mode='r',
+                         offset=img.dataobj.offset, shape=(int(np.prod(img.shape)),))
+
+    data = np.asarray(img.dataobj).ravel()
+
+    return data.astype(data.dtype.newbyteorder('='), copy=False)
+
+
+def load_map(path, cache=RESULT_CACHE, shared_store=SHARED_STORE):
+    """
+    Load a surface map through the process-wide cache.
+    Maps are read from the consolidated result pack of their directory when there is one (see backend_store),
+    otherwise from the .mgh file itself, decoded once into the shared cross-worker cache if there is one. Entries are
+    keyed on (path, mtime, size) so files that are overwritten on disk are read again. The returned array is
+    read-only: copy it before modifying it.
+    """
+    folder, file_name = os.path.split(path)
+
+    pack = open_pack(folder)
+    if pack is not None and file_name in pack:
+        # Pack columns are memory-mapped (and in native byte order) already, so they are shared across workers as is
+        key = (pack.path, pack.mtime_ns, pack.size, file_name)
+        read = lambda: pack.read(file_name)
+    else:
+        st = os.stat(path)  # raises FileNotFoundError for missing maps
+        key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        if shared_store is not None:
+            read = lambda: shared_store.get_or_create(key, lambda: read_mgh(path, mmap=False))
+        else:
+            read = lambda: read_mgh(path)
+
+    data = cache.get(key)
+    if data is None:
+        data = cache.put(key, read())
+
+    return data
+
+
+def read_stack_names(mdir):
+    """Read the stack number / name table of a model directory (from its result pack if there is one)."""
+    import pandas as pd
+
+    pack = open_pack(mdir)
+    if pack is not None and pack.stack_names is not None:
+        return pd.read_table(io.StringIO(pack.stack_names), delimiter="\t")
+
+    return pd.read_table(os.path.join(mdir, 'stack_names.txt'), delimiter="\t")
+
+# ===== CONSOLIDATED RESULT PACKS ======================================================================================
+
+# A result pack consolidates all the maps in a model directory into one binary file:
+#   - 8 bytes magic, 8 bytes (little-endian) header length, JSON header, zero padding up to a 64-byte boundary
+#   - one vertex x stack matrix per "series" of maps (e.g. 'lh.area.stack{}.coef.mgh'), stored column-major so that
+#     each stack is a contiguous column that can be memory-mapped without reading the rest of the file
+# The header also holds the content of stack_names.txt, precomputed cluster summaries for each term and the
+# (mtime, size) of each packed map: maps whose file was changed since are read from the file instead.
+
+PACK_FILENAME = 'results.vwpack'
+PACK_MAGIC = b'VWPACK01'
+PACK_ALIGN = 64
+
+_OPEN_PACKS = {}
+
+
+def split_stack_name(file_name):
+    """Split e.g. 'lh.area.stack3.coef.mgh' into its series ('lh.area.stack{}.coef.mgh') and stack number (3)."""
+    m = re.match(r'^(.*?)(^|\.)stack(\d+)\.(.*)$', file_name)
+    if not m:
+        return None, None
+    prefix, sep, stack, suffix = m.groups()
+    return f'{prefix}{sep}stack{{}}.{suffix}', int(stack)
+
+
+class ResultPack:
+
+    def __init__(self, path):
+        st = os.stat(path)
+        self.path = os.path.abspath(path)
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+
+        with open(path, 'rb') as f:
+            if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+                raise ValueError(f'{path} is not a verywise wizard result pack.')
+            header_len = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(header_len).decode('utf-8'))
+
+        self.series = header['series']
+        self.stack_names = header.get('stack_names')
+        self.summaries = header.get('summaries', {})
+        self._matrices = {}
+
+    def members(self):
+        """Names of the original files consolidated in the pack."""
+        return [series.format(stack) for series, info in self.series.items() for stack in info['stacks']]
+
+    def __contains__(self, file_name):
+        series, stack = split_stack_name(file_name)
+        return series in self.series and stack in self.series[series]['stacks'] and self.is_current(file_name)
+
+    def is_current(self, file_name):
+        """Whether a packed map is still that of its file (always true if the file was removed after packing)."""
+        series, stack = split_stack_name(file_name)
+        info = self.series[series]
+        if 'sources' not in info:  # packed before the (mtime, size) of the maps were recorded
+            return True
+        try:
+            st = os.stat(os.path.join(os.path.dirname(self.path), file_name))
+        except OSError:
+            return True
+        if [st.st_mtime_ns, st.st_size] == info['sources'][info['stacks'].index(stack)]:
+            return True
+
+        warnings.warn(f'{file_name} changed since it was packed into {self.path}: it is read from the file instead '
+                      f'(pack the directory again to include the change).')
+        return False
+
+    def matrix(self, series):
+        """Memory-mapped (read-only) vertex x stack matrix of one series of maps."""
+        if series not in self._matrices:
+            info = self.series[series]
+            self._matrices[series] = np.memmap(self.path, dtype=np.dtype(info['dtype']), mode='r',
+                                               offset=info['offset'], shape=tuple(info['shape']), order='F')
+        return self._matrices[series]
+
+    def read(self, file_name):
+        series, stack = split_stack_name(file_name)
+        return self.matrix(series)[:, self.series[series]['stacks'].index(stack)]
+
+
+def open_pack(mdir):
+    """Return the result pack of a directory (re-opened if it changed on disk), or None if there is none."""
+    path = os.path.join(mdir, PACK_FILENAME)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    pack = _OPEN_PACKS.get(path)
+    if pack is None or (pack.mtime_ns, pack.size) != (st.st_mtime_ns, st.st_size):
+        pack = _OPEN_PACKS[path] = ResultPack(path)
+
+    return pack
+
+# ===== SIDECAR DIRECTORIES ============================================================================================
+# The files the app derives from a results directory (the directory index, term summaries, mask indexes and vertex
+# tables) are not written into it, but into a directory per results (or model) directory under SIDECAR_DIR, keyed on
+# its real path. The results are thus never modified, and their modification times only change with the results.
+
+SIDECAR_DIR = os.environ.get('VWW_SIDECAR_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'vwwizard', 'sidecars'))
+
+
+def sidecar_path(directory, file_name):
+    """Location of one of the app's files about a (results or model) directory."""
+    real_path = os.path.realpath(directory)
+    key = f'{os.path.basename(real_path)}-{hashlib.sha1(real_path.encode()).hexdigest()[:16]}'
+    return os.path.join(SIDECAR_DIR, key, file_name)
+
+
+def write_sidecar_json(path, content):
+    """Write a JSON sidecar atomically (False if it could not be written, e.g. without a writable cache)."""
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(content, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        return False
+    return True
+
+
+class SidecarCache:
+    """
+    Process-wide LRU of at most max_entries values read from (or built for) sidecar files, keyed on the sidecar path
+    and stored with the source they were built from (e.g. the terms and map signatures): a value is only returned for
+    the same source, and replaced (not added to) when the source changes.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = int(max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, source):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry[0] != source:
+                return None
+            self._entries.move_to_end(path)
+            return entry[1]
+
+    def put(self, path, source, value):
+        with self._lock:
+            self._entries[path] = (source, value)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+# ===== TERM SUMMARY SIDECARS ==========================================================================================
+# Each model directory can have a small JSON sidecar with, for every term (keyed on its coef.mgh file name), the cluster
+# count, beta range, per-cluster statistics and a binned density of the observed betas (see summarise_term), so these
+# can be shown without loading the maps. Each entry records the (mtime, size) of the maps it was computed from and is
+# ignored once they change. Result packs hold the same summaries in their header.
+
+SUMMARY_FILENAME = 'summary.json'
+SUMMARY_VERSION = 1
+
+_SUMMARIES = {}
+_SUMMARIES_LOCK = threading.Lock()  # sidecars are updated by several threads (e.g. one per hemisphere)
+
+
+def map_signature(path):
+    """(mtime, size) of a map, or of the result pack it is stored in. None if the map does not exist."""
+    folder, file_name = os.path.split(path)
+
+    pack = open_pack(folder)
+    if pack is not None and file_name in pack:
+        return [pack.mtime_ns, pack.size]
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def read_summaries(mdir):
+    """All the term summaries stored in the sidecar of a model directory (re-read only when the file changed)."""
+    path = sidecar_path(mdir, SUMMARY_FILENAME)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return {}
+
+    cached = _SUMMARIES.get(path)
+    if cached is None or cached[0] != (st.st_mtime_ns, st.st_size):
+        try:
+            with open(path) as f:
+                sidecar = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        terms = sidecar.get('terms', {}) if sidecar.get('version') == SUMMARY_VERSION else {}
+        cached = _SUMMARIES[path] = ((st.st_mtime_ns, st.st_size), terms)
+
+    return cached[1]
+
+
+def write_summaries(mdir, summaries):
+    """Add (or replace) term summaries ({coef file name: summary}) in the sidecar of a model directory."""
+    with _SUMMARIES_LOCK:
+        terms = dict(read_summaries(mdir))
+        terms.update(summaries)
+        # (if it cannot be written, summaries are computed from the maps instead)
+        write_sidecar_json(sidecar_path(mdir, SUMMARY_FILENAME), {'version': SUMMARY_VERSION, 'terms': terms})
+
+
+def read_term_summary(mdir, coef_name, ocn_name):
+    """Summary of one term, from the result pack or the sidecar, or None if there is none for the current maps."""
+    pack = open_pack(mdir)
+    if pack is not None and coef_name in pack and ocn_name in pack and coef_name in pack.summaries:
+        return pack.summaries[coef_name]
+
+    entry = read_summaries(mdir).get(coef_name)
+    if entry is None or entry.get('source') != [map_signature(os.path.join(mdir, f)) for f in (coef_name, ocn_name)]:
+        return None
+
+    return entry
+
+# ===== SIGNIFICANCE MASK INDEX FILES ==================================================================================
+# The significance masks of all terms of a model / measure, bit-packed into one (vertices x terms / 8) uint8 matrix per
+# hemisphere (see significance_index), are stored in the sidecar directory of the maps (masks.<hemi>.<measure>.npz) with
+# the terms and the (mtime, size) of the cluster maps they were built from, and ignored once these change.
+
+MASK_INDEX_PREFIX = 'masks'
+
+
+def mask_index_path(mdir, hemi, meas):
+    return sidecar_path(mdir, f'{MASK_INDEX_PREFIX}.{hemi}.{meas}.npz')
+
+
+def read_mask_index(path, terms, source):
+    """Bit-packed masks stored for the given terms and cluster map signatures, or None."""
+    try:
+        with np.load(path) as stored:
+            if json.loads(str(stored['meta'])) != {'terms': terms, 'source': source}:
+                return None
+            return stored['bits']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_mask_index(path, bits, terms, source):
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, bits=bits, meta=np.array(json.dumps({'terms': terms, 'source': source})))
+        os.replace(tmp_path, path)
+    except OSError:
+        pass  # e.g. no writable cache: the index is rebuilt by each process instead
+
+# ===== VERTEX TABLE FILES =============================================================================================
+# The beta and cluster id of all terms of a model / measure, in one vertex-major float32 (vertices x terms x 2) array
+# per hemisphere (see vertex_table), are stored in the sidecar directory of the maps as .npy files
+# (vertex.<hemi>.<measure>.npy), so they can be memory-mapped, with the terms and the (mtime, size) of the maps they
+# were built from in a .json file.
+
+VERTEX_TABLE_PREFIX = 'vertex'
+
+
+def vertex_table_path(mdir, hemi, meas):
+    return sidecar_path(mdir, f'{VERTEX_TABLE_PREFIX}.{hemi}.{meas}.npy')
+
+
+def read_vertex_table(path, terms, source):
+    """Memory-mapped vertex table stored for the given terms and map signatures, or None."""
+    try:
+        with open(f'{path[:-len(".npy")]}.json') as f:
+            if json.load(f) != {'terms': terms, 'source': source}:
+                return None
+        table = np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    return table if table.ndim == 3 and table.shape[1] == len(terms) else None
+
+
+def write_vertex_table(path, table, terms, source):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        save_array(path, table)
+    except OSError:
+        return  # e.g. no writable cache: the table is rebuilt by each process instead
+    write_sidecar_json(f'{path[:-len(".npy")]}.json', {'terms': terms, 'source': source})
@@ -0,0 +1,300 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import contextlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from shiny import ui
+from shiny.session import get_current_session
+
+GITHUB_API = 'https://api.github.com'
+
+# Downloaded folders and archives (and their extracted results) are kept in a cache directory, not in the working
+# directory (e.g. the checkout of the app)
+DOWNLOAD_DIR = os.environ.get('VWW_DOWNLOAD_DIR',
+                              os.path.join(os.path.expanduser('~'), '.cache', 'vwwizard', 'downloads'))
+
+DOWNLOAD_WORKERS = 8  # number of files downloaded in parallel (and size of the connection pool)
+DOWNLOAD_CHUNK_SIZE = 1024 ** 2  # files are streamed to disk in chunks of 1 MB
+
+# The manifest records the GitHub blob SHA of each downloaded file, so unchanged files are not downloaded again
+MANIFEST_FILENAME = '.github_manifest.json'
+
+_GITHUB_FOLDER_CACHE = {}
+
+# Archives (local or remote) are extracted selectively: only the members needed by the app
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+ARCHIVE_MEMBERS = ('coef.mgh', 'ocn.mgh', 'stack_names.txt')
+ARCHIVE_MARKER = '.archive_source.json'
+
+# ===== HELPERS ========================================================================================================
+
+
+def progress_bar(max_value):
+    """Shiny progress bar, or a no-op when called outside a Shiny session (e.g. from a script)."""
+    if get_current_session() is None:
+        return contextlib.nullcontext()
+    return ui.Progress(min=0, max=max_value)
+
+
+def http_session(github_token=None, pool_size=DOWNLOAD_WORKERS):
+    """A requests session with a connection pool large enough for all download workers."""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    # Try to get token from environment if not provided
+    if github_token is None:
+        github_token = os.environ.get("GITHUB_TOKEN")
+    if github_token:
+        session.headers["Authorization"] = f"token {github_token}"
+
+    return session
+
+
+def download_file(session, url, local_file, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Stream a file to disk (through a temporary file, so that interrupted downloads leave nothing behind)."""
+    os.makedirs(os.path.dirname(local_file), exist_ok=True)
+
+    with session.get(url, stream=True) as resp:
+        resp.raise_for_status()
+        with open(f'{local_file}.part', 'wb') as f:
+            for chunk in resp.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+
+    os.replace(f'{local_file}.part', local_file)
+
+    return local_file
+
+# ===== GITHUB FOLDERS =================================================================================================
+
+
+def list_github_folder(session, api_url, rel_dir=''):
+    """Recursively list the files in a GitHub folder as {relative path: (blob SHA, download url)}."""
+    resp = session.get(api_url)
+    resp.raise_for_status()
+
+    files = {}
+    for file_info in resp.json():
+        rel_path = os.path.join(rel_dir, file_info['name'])
+
+        if file_info["type"] == "dir":
+            files.update(list_github_folder(session, file_info["url"], rel_path))
+
+        elif file_info["type"] == "file":
+            files[rel_path] = (file_info['sha'], file_info['download_url'])
+
+    return files
+
+
+def read_manifest(folder_local):
+    try:
+        with open(os.path.join(folder_local, MANIFEST_FILENAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(folder_local, source, file_shas):
+    with open(os.path.join(folder_local, MANIFEST_FILENAME), 'w') as f:
+        json.dump({'source': source, 'files': file_shas}, f)
+
+
+def github_folder_location(github_url, download_loc):
+    """Local folder for a given GitHub folder url, so that different folders never overwrite each other."""
+    key = hashlib.sha1(str(github_url).encode('utf-8')).hexdigest()[:16]
+    return Path(download_loc) / 'tmp_results' / key
+
+
+def download_github_folder(github_url, download_loc=DOWNLOAD_DIR, github_token=None,
+                           api_root=GITHUB_API, max_workers=DOWNLOAD_WORKERS):
+    """
+    Downloads a folder from a public GitHub repo to a local directory.
+    github_url: e.g. https://github.com/user/repo/tree/main/path/to/folder
+    Files are downloaded in parallel and only if their SHA changed since the previous download (the local copy
+    persists across restarts). api_root can point to any server that mimics the GitHub contents API.
+    Returns the local path to the downloaded folder.
+    """
+    # Check cache first
+    if github_url in _GITHUB_FOLDER_CACHE:
+        return _GITHUB_FOLDER_CACHE[github_url]
+
+    m = re.match(r"https://github.com/([^/]+)/([^/]+)/tree/([^/]+)/(.*)", github_url)
+    if not m:
+        raise ValueError("URL must be of the form https://github.com/user/repo/tree/branch/path/to/folder")
+    user, repo, branch, folder_path = m.groups()
+
+    api_url = f"{api_root}/repos/{user}/{repo}/contents/{folder_path}?ref={branch}"
+    folder_local = github_folder_location(github_url, download_loc)
+
+    # Only re-use previous downloads of the same folder
+    manifest = read_manifest(folder_local)
+    if manifest.get('source') != github_url and folder_local.exists():
+        shutil.rmtree(folder_local, ignore_errors=True)
+        manifest = {}
+    os.makedirs(folder_local, exist_ok=True)
+
+    local_shas = manifest.get('files', {})
+
+    session = http_session(github_token, pool_size=max_workers)
+
+    remote_files = list_github_folder(session, api_url)
+
+    # Remove files that were deleted from the repo since the previous download
+    for rel_path in set(local_shas) - set(remote_files):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(folder_local / rel_path)
+        del local_shas[rel_path]
+
+    to_download = {rel_path: info for rel_path, info in remote_files.items()
+                   if local_shas.get(rel_path) != info[0] or not (folder_local / rel_path).is_file()}
+
+    try:
+        with progress_bar(max_value=len(to_download)) as p, ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(download_file, session, url, folder_local / rel_path): (rel_path, sha)
+                       for rel_path, (sha, url) in to_download.items()}
+
+            for e, future in enumerate(as_completed(futures)):
+                rel_path, sha = futures[future]
+                future.result()  # re-raise download errors
+                local_shas[rel_path] = sha
+
+                if p is not None:
+                    p.set(value=e + 1, message=f"Downloading [{e + 1}/{len(to_download)}]: "
+                                               f"{os.path.basename(rel_path)}...")
+    finally:
+        # Record what was downloaded, even if some of the downloads failed
+        write_manifest(folder_local, github_url, local_shas)
+        session.close()
+
+    # Store in cache
+    _GITHUB_FOLDER_CACHE[github_url] = folder_local
+
+    return folder_local
+
+# ===== ARCHIVES =======================================================================================================
+
+
+def is_archive(path):
+    return str(path).split('?')[0].lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def archive_location(source, download_loc):
+    """Local folder for a given archive (path or url), so that different archives never overwrite each other."""
+    key = hashlib.sha1(str(source).encode('utf-8')).hexdigest()[:16]
+    return Path(download_loc) / 'tmp_archives' / key
+
+
+def read_marker(folder):
+    try:
+        with open(os.path.join(folder, ARCHIVE_MARKER)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def fetch_archive(archive_url, download_loc=DOWNLOAD_DIR, github_token=None):
+    """
+    Stream a remote archive to disk. The download is conditional: if the server reports (via ETag / Last-Modified)
+    that the archive did not change since the previous download, the local copy is re-used.
+    Returns the local path to the archive.
+    """
+    folder = archive_location(archive_url, download_loc)
+    os.makedirs(folder, exist_ok=True)
+
+    archive_name = os.path.basename(archive_url.split('?')[0])
+    local_file = folder / archive_name
+    marker = read_marker(folder)
+
+    session = http_session(github_token, pool_size=1)
+    if local_file.is_file() and marker.get('source') == archive_url:
+        if marker.get('etag'):
+            session.headers['If-None-Match'] = marker['etag']
+        if marker.get('last_modified'):
+            session.headers['If-Modified-Since'] = marker['last_modified']
+
+    with progress_bar(max_value=1) as p:
+        if p is not None:
+            p.set(value=0, message=f"Downloading {archive_name}...")
+
+        with session, session.get(archive_url, stream=True) as resp:
+            if resp.status_code == 304:  # not modified
+                return local_file
+            resp.raise_for_status()
+
+            with open(f'{local_file}.part', 'wb') as f:
+                for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+            os.replace(f'{local_file}.part', local_file)
+
+            with open(folder / ARCHIVE_MARKER, 'w') as f:
+                json.dump({'source': archive_url,
+                           'etag': resp.headers.get('ETag'),
+                           'last_modified': resp.headers.get('Last-Modified')}, f)
+
+    return local_file
+
+
+def archive_members(archive_path):
+    """Iterate over (member name, open file object) of the files in a zip or tar archive, reading it sequentially."""
+    if str(archive_path).lower().endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    with zf.open(info) as f:
+                        yield info.filename, f
+    else:
+        with tarfile.open(archive_path, mode='r|*') as tf:  # streaming mode: no random access needed
+            for member in tf:
+                if member.isfile():
+                    yield member.name, tf.extractfile(member)
+
+
+def extract_results_archive(archive_path, download_loc=DOWNLOAD_DIR):
+    """
+    Extract only the result maps (coef and ocn .mgh files) and stack_names.txt from a zip or tar archive.
+    Extraction is skipped if the archive did not change since it was last extracted.
+    Returns the local results directory (without the single top-level folder most archives are wrapped in).
+    """
+    archive_path = os.path.abspath(archive_path)
+    st = os.stat(archive_path)
+    archive_id = [archive_path, st.st_size, st.st_mtime_ns]
+
+    extract_dir = archive_location(archive_path, download_loc) / 'extracted'
+    marker = read_marker(extract_dir)
+
+    if marker.get('archive') != archive_id:
+        shutil.rmtree(extract_dir, ignore_errors=True)
+        os.makedirs(extract_dir)
+
+        with progress_bar(max_value=1) as p:
+            if p is not None:
+                p.set(value=0, message=f"Extracting {os.path.basename(archive_path)}...")
+
+            for name, f in archive_members(archive_path):
+                rel_path = os.path.normpath(name)
+                # Skip unneeded members and anything that would end up outside the extraction folder
+                if not rel_path.endswith(ARCHIVE_MEMBERS) or os.path.isabs(rel_path) or rel_path.startswith('..'):
+                    continue
+
+                os.makedirs(extract_dir / os.path.dirname(rel_path), exist_ok=True)
+                with open(extract_dir / rel_path, 'wb') as out:
+                    shutil.copyfileobj(f, out, DOWNLOAD_CHUNK_SIZE)
+
+        with open(extract_dir / ARCHIVE_MARKER, 'w') as f:
+            json.dump({'archive': archive_id}, f)
+
+    top_level = [d for d in os.listdir(extract_dir) if d != ARCHIVE_MARKER]
+    if len(top_level) == 1 and os.path.isdir(extract_dir / top_level[0]):
+        return extract_dir / top_level[0]
+
+    return extract_dir
@@ -1,26 +1,40 @@
-import numpy as np
+import os
+import hashlib
 
-from nilearn import plotting
+import numpy as np
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import matplotlib.transforms as transforms
 from matplotlib.colors import ListedColormap
 
-from scipy.stats import gaussian_kde
-
-from definitions.backend_calculations import calc_betainfo_bycluster, fetch_surface, fetch_cont_colormap
+from definitions.backend_calculations import calc_betainfo_bycluster, fetch_surface, fetch_cont_colormap, \
+    beta_density, summary_density, DENSITY_CACHE
+from definitions.backend_io import SHARED_CACHE_DIR, file_lock, save_array, map_hemis
+from definitions.backend_surfaces import downsample_map
 
 
 # ===== BETA AND CLUSTER LEGENDS FOR APP ==============================================================
 
 
-def plot_beta_colorbar_density(ax1, ax2, sign_betas, all_betas, colorblind=False, set_range=None):
-
-    obs_betas = np.concatenate((all_betas['left'], all_betas['right']), axis=None)
-    min_obs_beta = np.nanmin(obs_betas)
-    max_obs_beta = np.nanmax(obs_betas)
-    obs_betas = obs_betas[obs_betas != 0.00000]  # TMP: clean out all values exactly equal to 0
+def plot_beta_colorbar_density(ax1, ax2, sign_betas, all_betas, colorblind=False, set_range=None, cache_key=None,
+                               summaries=None):
+    """
+    cache_key (e.g. (resdir, model, term, measure)) identifies the maps, so their density is only estimated once.
+    summaries (the term summaries of both hemispheres) hold a binned histogram of the observed betas, which is used
+    instead of all_betas when given.
+    """
+    if summaries is not None and all(s.get('density') and s.get('obs_range') for s in summaries):
+        obs_betas = None
+        min_obs_beta = min(s['obs_range'][0] for s in summaries)
+        max_obs_beta = max(s['obs_range'][1] for s in summaries)
+    else:
+        summaries = None
+        obs_betas = np.concatenate((all_betas['left'], all_betas['right']), axis=None)
+        min_obs_beta = np.nanmin(obs_betas)
+        max_obs_beta = np.nanmax(obs_betas)
+        obs_betas = obs_betas[obs_betas != 0.00000]  # TMP: clean out all values exactly equal to 0
 
     sign_betas = np.concatenate((sign_betas['left'], sign_betas['right']), axis=None)
 
@@ -74,13 +88,19 @@ def plot_beta_colorbar_density(ax1, ax2, sign_betas, all_betas, colorblind=False
         ax1.set_ylim(set_range[0], set_range[1])
 
     # PLOT 2: HISTOGRAM -------------------------------------------------------------------------------
-    density = gaussian_kde(obs_betas)
+    key = None if cache_key is None else (cache_key, min_obs_beta, max_obs_beta)
+
+    density = None if key is None else DENSITY_CACHE.get(key)
+    if density is None:
+        density = beta_density(obs_betas, lspace) if summaries is None else summary_density(summaries, lspace)
+        if key is not None:
+            DENSITY_CACHE.put(key, density)
 
     # Density line
-    ax2.plot(density(lspace), lspace, lw=0.5, alpha=0.3, color='k', zorder=2)
+    ax2.plot(density, lspace, lw=0.5, alpha=0.3, color='k', zorder=2)
 
     # Color significant portion
-    polygon = ax2.fill_betweenx(y=lspace, x1=density(lspace), where=color_where, lw=0, color='none')
+    polygon = ax2.fill_betweenx(y=lspace, x1=density, where=color_where, lw=0, color='none')
     verts = np.vstack([p.vertices for p in polygon.get_paths()])
 
     gradient = ax2.imshow(np.linspace(0, 1, 256).reshape(-1, 1),
@@ -99,18 +119,20 @@ def plot_beta_colorbar_density(ax1, ax2, sign_betas, all_betas, colorblind=False
     else:
         ax2.set_ylim(set_range[0], set_range[1])
 
-    ax2.set_xlim(0, np.nanmax(density(lspace)))
+    ax2.set_xlim(0, np.nanmax(density))
 
     ax2.axis('off')
 
 
 def beta_colorbar_density_figure(sign_betas, all_betas, figsize=(4, 6),
-                                 colorblind=False, set_range=None):
+                                 colorblind=False, set_range=None, cache_key=None, summaries=None):
 
-    # Figure set up
-    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=figsize, width_ratios=[1, 5])
+    # Figure set up (not managed by pyplot, so that it can be drawn in a background thread, see ui_functions)
+    fig = Figure(figsize=figsize)
+    ax1, ax2 = fig.subplots(1, 2, width_ratios=[1, 5])
 
-    plot_beta_colorbar_density(ax1, ax2, sign_betas, all_betas, colorblind=colorblind, set_range=set_range)
+    plot_beta_colorbar_density(ax1, ax2, sign_betas, all_betas, colorblind=colorblind, set_range=set_range,
+                               cache_key=cache_key, summaries=summaries)
 
     return fig
 
@@ -175,12 +197,13 @@ def plot_clusterwise_means(fig, ax, df, cmap, tot_clusters):
 
 
 def clusterwise_means_figure(sign_clusters, sign_betas,
-                             cmap, tot_clusters, figsize=(4, 6)):
+                             cmap, tot_clusters, figsize=(4, 6), stats=None):
 
-    betas_by_cluster = calc_betainfo_bycluster(sign_clusters, sign_betas)
+    betas_by_cluster = calc_betainfo_bycluster(sign_clusters, sign_betas, stats=stats)
 
-    # Figure set up
-    fig, ax = plt.subplots(1, 1, figsize=figsize)
+    # Figure set up (not managed by pyplot, as above)
+    fig = Figure(figsize=figsize)
+    ax = fig.subplots(1, 1)
 
     plot_clusterwise_means(fig, ax, betas_by_cluster, cmap=cmap, tot_clusters=tot_clusters)
 
@@ -189,76 +212,324 @@ def clusterwise_means_figure(sign_clusters, sign_betas,
 # ===== STATIC BRAIN PLOTS ==============================================================
 
 
+# Panels of the static figure: (hemisphere, view) drawn in each 3D axes of the mosaic, and their fixed y-limits
+BRAIN_PANELS = {'A': [('left', 'lateral')],
+                'B': [('right', 'lateral')],
+                'C': [('left', 'dorsal'), ('right', 'dorsal')],
+                'D': [('left', 'posterior'), ('right', 'posterior')],
+                'E': [('left', 'medial')],
+                'F': [('right', 'medial')],
+                'G': [('left', 'ventral'), ('right', 'ventral')],
+                'H': [('left', 'anterior'), ('right', 'anterior')]}
+PANEL_YLIMS = {'A': (-88, 90), 'B': (-88, 90), 'E': (-128, 50), 'F': (-128, 50)}
+
+# Camera (elevation, azimuth) of each view (as in nilearn.plotting.plot_surf)
+VIEW_ANGLES = {'left': {'lateral': (0, 180), 'medial': (0, 0), 'dorsal': (90, 0), 'ventral': (270, 0),
+                        'anterior': (0, 90), 'posterior': (0, 270)},
+               'right': {'lateral': (0, 0), 'medial': (0, 180), 'dorsal': (90, 0), 'ventral': (270, 0),
+                         'anterior': (0, 90), 'posterior': (0, 270)}}
+
+# Engine of the static brain views: 'raster' (z-buffer rasterisation of the projected meshes in NumPy) or
+# 'matplotlib' (nilearn-style plot_trisurf, drawn by mplot3d). The raster engine is the fast one: once the pixels of
+# each view are cached, a figure is a gather of face colours, so the views are not rendered in separate processes
+# (starting those costs more than the rendering). The matplotlib engine draws the views one after another.
+STATIC_ENGINE = os.environ.get('VWW_STATIC_ENGINE', 'raster')
+
+# The raster engine stores the front-most face at each pixel of every panel (per resolution, surface and figure size),
+# so that rendering a new map is a gather of its face colours. Set VWW_VIEW_CACHE_DIR to '' to only keep them in memory.
+VIEW_CACHE_DIR = os.environ.get('VWW_VIEW_CACHE_DIR', os.path.join(SHARED_CACHE_DIR, 'views') if SHARED_CACHE_DIR else
+                                os.path.join(os.path.expanduser('~'), '.cache', 'vwwizard', 'views'))
+VIEW_INDEX_VERSION = 1
+
+_VIEW_INDEX = {}
+
+
+def brain_mosaic(figure):
+    """Static figure layout: 3D axes A-H for the brains, a and b for the beta legend."""
+    return figure.subplot_mosaic('ABCDD..a.b;EFG.HH.a.b',
+                                 per_subplot_kw={('ABCDEFGH'): {'projection': '3d'}},
+                                 gridspec_kw=dict(wspace=0, hspace=0, width_ratios=[0.19, 0.19, 0.19, 0.02, 0.17,
+                                                                                    0.02, 0.08, 0.03, 0.01, 0.1]))
+
+
+def brain_face_colors(faces, stats_map, bg_map, cmap, darkness):
+    """
+    RGBA colour of each mesh face (mean of its vertex values), as computed by nilearn.plotting.plot_surf (matplotlib
+    engine): the colormap is scaled to the range of the face values, and faces with missing values show the
+    background map (in greys, scaled by darkness).
+    """
+    bg_faces = np.mean(bg_map[faces], axis=1)
+    if bg_faces.min() < 0 or bg_faces.max() > 1:
+        bg_faces = mpl.colors.Normalize(vmin=bg_faces.min(), vmax=bg_faces.max())(bg_faces)
+    colors = mpl.colormaps['gray_r'](bg_faces * darkness)
+
+    stats_faces = np.mean(stats_map[faces], axis=1)
+    kept = ~np.isnan(stats_faces)
+    if kept.any():
+        vmin, vmax = np.min(stats_faces[kept]), np.max(stats_faces[kept])
+        cmap = mpl.colormaps[cmap] if isinstance(cmap, str) else cmap
+        with np.errstate(invalid='ignore', divide='ignore'):  # a single value: NaN, shown as the colormap's "bad"
+            colors[kept] = cmap((stats_faces[kept] - vmin) / (vmax - vmin))
+
+    return colors
+
+
+def hemi_face_colors(hemi, sign_betas, surf='pial', resol='fsaverage5', colorblind=False):
+    """Mesh and face colours of one hemisphere of the static figure."""
+    fs_avg, _ = fetch_surface(resol)
+    mesh = fs_avg[f'{surf}_{hemi}']
+
+    stats_map = downsample_map(sign_betas[hemi], resol, hemi)
+
+    bg_darkness = 0.3 if np.isnan(stats_map).all() else 0.6
+
+    # Maps without clusters are all-NaN: tested for here, so NumPy has nothing to warn about in the hemisphere threads
+    sign_values = stats_map[~np.isnan(stats_map)]
+    if len(sign_values):
+        cmap, thresh = fetch_cont_colormap(stats_map=stats_map,
+                                           max_val=sign_values.max(),
+                                           min_val=sign_values.min(),
+                                           colorblind=colorblind)
+    else:  # no clusters: only the background is shown
+        cmap = 'viridis'
+
+    colors = brain_face_colors(mesh.faces, stats_map, np.asarray(fs_avg[f'sulc_{hemi}']), cmap, bg_darkness)
+
+    return mesh, colors
+
+
+def draw_brain_view(ax, mesh, colors, hemi, view):
+    """Draw a mesh with the given face colours in a 3D axes (same camera and framing as nilearn's plot_surf)."""
+    coords, faces = np.asarray(mesh.coordinates), np.asarray(mesh.faces)
+    limits = [coords.min(), coords.max()]
+
+    ax.set_xlim(*limits)
+    ax.set_ylim(*limits)
+    ax.view_init(*VIEW_ANGLES[hemi][view])
+    ax.set_axis_off()
+
+    p3dcollec = ax.plot_trisurf(coords[:, 0], coords[:, 1], coords[:, 2],
+                                triangles=faces, linewidth=0.1, antialiased=False, color='white')
+    ax.set_box_aspect(None, zoom=1.3)
+
+    p3dcollec.set_facecolors(colors)
+    p3dcollec.set_edgecolors(colors)
+
+
+def draw_brain_panel(ax, panel, hemi_colors):
+    for hemi, view in BRAIN_PANELS[panel]:
+        mesh, colors = hemi_colors[hemi]
+        draw_brain_view(ax, mesh, colors, hemi, view)
+    if panel in PANEL_YLIMS:
+        ax.set_ylim3d(*PANEL_YLIMS[panel])
+
+
 def plot_single_brain(ax, hemi, coord, fig, sign_betas, surf='pial', resol='fsaverage5', colorblind=False):
 
-    fs_avg, n_nodes = fetch_surface(resol)
+    mesh, colors = hemi_face_colors(hemi, sign_betas, surf=surf, resol=resol, colorblind=colorblind)
 
-    stats_map = sign_betas[hemi]  # sign_betas
-    bg_color = fs_avg[f'sulc_{hemi}']
+    draw_brain_view(ax, mesh, colors, hemi, coord)
 
-    bg_darkness = 0.3 if np.isnan(stats_map).all() else 0.6
+    return fig
 
-    min_sign_beta = np.nanmin(stats_map)
-    max_sign_beta = np.nanmax(stats_map)
-    
-    cmap, thresh = fetch_cont_colormap(stats_map=stats_map,
-                                       max_val=max_sign_beta,
-                                       min_val=min_sign_beta,
-                                       colorblind=colorblind)
-
-    p = plotting.plot_surf(surf_mesh=fs_avg[f'{surf}_{hemi}'],  # Surface mesh geometry
-                           surf_map=stats_map[:n_nodes],  # Statistical map confounder model
-                           bg_map=bg_color,
-                           # alpha=0.01,
-                           darkness=bg_darkness,  # of the bg_map
-                           hemi=hemi,
-                           view=coord,
-                           cmap=cmap,
-                           symmetric_cmap=False,
-                           axes=ax,
-                           figure=fig,
-                           colorbar=False)
-    return p
 
+def frame_brain_view(ax, coords, hemi, view, had_data=False):
+    """
+    Set the camera and data limits of a 3D axes exactly as draw_brain_view does (through plot_trisurf), without
+    drawing the mesh. had_data: whether another mesh was already framed in the same axes.
+    """
+    limits = [coords.min(), coords.max()]
+
+    ax.set_xlim(*limits)
+    ax.set_ylim(*limits)
+    ax.view_init(*VIEW_ANGLES[hemi][view])
+    ax.set_axis_off()
 
-def plot_brain_2d(sign_betas, all_observed_betas, 
-                 model, meas, resol='fsaverage5', title=None):
+    ax.auto_scale_xyz(coords[:, 0], coords[:, 1], coords[:, 2], had_data)
+    ax.set_box_aspect(None, zoom=1.3)
+
+
+def rasterize_faces(xy, depth, faces, width, height, chunk_size=2 ** 22):
+    """
+    Z-buffer rasterisation of a triangle mesh projected to display coordinates (pixels, x to the right and y up).
+    Each pixel shows the face with the smallest depth among those covering its centre. Candidate pixels are taken
+    from the bounding box of each face, in chunks of at most chunk_size pixels.
+    Returns an image (row 0 at the top) of face indices, -1 where no face is drawn.
+    """
+    tri = xy[faces]
+    tri_z = depth[faces]
+
+    # Pixel centres (i + 0.5) within the bounding box of each face
+    x0 = np.maximum(np.ceil(tri[..., 0].min(axis=1) - 0.5), 0).astype(np.int64)
+    x1 = np.minimum(np.floor(tri[..., 0].max(axis=1) - 0.5), width - 1).astype(np.int64)
+    y0 = np.maximum(np.ceil(tri[..., 1].min(axis=1) - 0.5), 0).astype(np.int64)
+    y1 = np.minimum(np.floor(tri[..., 1].max(axis=1) - 0.5), height - 1).astype(np.int64)
+    nx, ny = np.maximum(x1 - x0 + 1, 0), np.maximum(y1 - y0 + 1, 0)
+
+    # Barycentric coordinates of b and c as linear functions of the offset to a; depth interpolated linearly
+    (ax_, ay_), b, c = tri[:, 0].T, tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0]
+    area = b[:, 0] * c[:, 1] - b[:, 1] * c[:, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wb = np.stack([c[:, 1], -c[:, 0]], axis=1) / area[:, None]
+        wc = np.stack([-b[:, 1], b[:, 0]], axis=1) / area[:, None]
+    dz_b, dz_c = tri_z[:, 1] - tri_z[:, 0], tri_z[:, 2] - tri_z[:, 0]
+
+    face_ids = np.flatnonzero((nx * ny > 0) & (area != 0))
+    n_pixels = (nx * ny)[face_ids]
+    bounds = np.searchsorted(np.cumsum(n_pixels), np.arange(chunk_size, n_pixels.sum() + chunk_size, chunk_size))
+
+    zbuffer = np.full(width * height, np.inf)
+    index = np.full(width * height, -1, dtype=np.int64)
+
+    for chunk_faces, chunk_pixels in zip(np.split(face_ids, bounds[:-1] + 1), np.split(n_pixels, bounds[:-1] + 1)):
+        f = np.repeat(chunk_faces, chunk_pixels)
+        k = np.arange(len(f)) - np.repeat(np.cumsum(chunk_pixels) - chunk_pixels, chunk_pixels)
+        px, py = x0[f] + k % nx[f], y0[f] + k // nx[f]
+
+        dx, dy = px + 0.5 - ax_[f], py + 0.5 - ay_[f]
+        beta = dx * wb[f, 0] + dy * wb[f, 1]
+        gamma = dx * wc[f, 0] + dy * wc[f, 1]
+        inside = (beta >= -1e-9) & (gamma >= -1e-9) & (beta + gamma <= 1 + 1e-9)
+
+        f, pix = f[inside], (py * width + px)[inside]
+        z = tri_z[f, 0] + beta[inside] * dz_b[f] + gamma[inside] * dz_c[f]
+
+        # Front-most candidate of each pixel, then the z-test against the previous chunks
+        order = np.lexsort((z, pix))
+        pix, z, f = pix[order], z[order], f[order]
+        first = np.ones(len(pix), dtype=bool)
+        first[1:] = pix[1:] != pix[:-1]
+        pix, z, f = pix[first], z[first], f[first]
+
+        closer = z < zbuffer[pix]
+        zbuffer[pix[closer]] = z[closer]
+        index[pix[closer]] = f[closer]
+
+    return index.reshape(height, width)[::-1]
+
+
+def brain_panel_index(ax, panel, meshes):
+    """
+    Front-most face at each pixel of one panel (3D axes) of the static figure, with the meshes (one per (hemi, view)
+    of the panel) projected by the same camera as the matplotlib engine. Face indices count through the meshes in
+    order. Returns the (top, left) pixel position and the face indices of the smallest box that holds the brains.
+    """
+    from mpl_toolkits.mplot3d import proj3d
+
+    for e, ((hemi, view), mesh) in enumerate(zip(BRAIN_PANELS[panel], meshes)):
+        frame_brain_view(ax, np.asarray(mesh.coordinates), hemi, view, had_data=e > 0)
+    if panel in PANEL_YLIMS:
+        ax.set_ylim3d(*PANEL_YLIMS[panel])
+
+    coords = np.concatenate([np.asarray(mesh.coordinates, dtype=np.float64) for mesh in meshes])
+    offsets = np.cumsum([0] + [len(mesh.coordinates) for mesh in meshes[:-1]])
+    faces = np.concatenate([np.asarray(mesh.faces) + offset for mesh, offset in zip(meshes, offsets)])
+
+    ax.apply_aspect()  # the axes box is only fitted to the box aspect when drawn
+    x, y, depth = proj3d.proj_transform(coords[:, 0], coords[:, 1], coords[:, 2], ax.get_proj())
+    xy = ax.transData.transform(np.column_stack([x, y]))
+
+    width, height = ax.figure.canvas.get_width_height()
+    index = rasterize_faces(xy, depth, faces, width, height)
+
+    rows, cols = np.nonzero((index >= 0).any(axis=1))[0], np.nonzero((index >= 0).any(axis=0))[0]
+    if len(rows) == 0:
+        return 0, 0, np.zeros((0, 0), dtype=np.int64)
+
+    return rows[0], cols[0], index[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+
+def _view_cache_files(key):
+    name = '_'.join(str(k) for k in key[:3]) + '_' + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+    return [os.path.join(VIEW_CACHE_DIR, f'{name}_{part}.npy') for part in ('origin', 'index')]
+
+
+def panel_face_index(ax, panel, meshes, resol='fsaverage5', surf='pial'):
+    """
+    brain_panel_index, computed once per resolution, surface, panel and pixel geometry of the axes: kept in memory
+    and (memory-mapped from) VIEW_CACHE_DIR.
+    """
+    width, height = ax.figure.canvas.get_width_height()
+    key = (resol, surf, panel, width, height, tuple(np.round(ax.get_position().bounds, 6)), mpl.__version__,
+           VIEW_INDEX_VERSION)
+
+    if key not in _VIEW_INDEX:
+        if not VIEW_CACHE_DIR:
+            _VIEW_INDEX[key] = brain_panel_index(ax, panel, meshes)
+        else:
+            cache_files = _view_cache_files(key)
+            if not all(os.path.isfile(f) for f in cache_files):
+                os.makedirs(VIEW_CACHE_DIR, exist_ok=True)
+                with file_lock(cache_files[0]):  # one process computes the index, the others wait for it
+                    if not all(os.path.isfile(f) for f in cache_files):
+                        top, left, index = brain_panel_index(ax, panel, meshes)
+                        save_array(cache_files[1], index.astype(np.int32))
+                        save_array(cache_files[0], np.array([top, left]))
+
+            (top, left), index = (np.load(f, mmap_mode='r') for f in cache_files)
+            _VIEW_INDEX[key] = int(top), int(left), index
+
+    return _VIEW_INDEX[key]
 
-    title = f'{model} ({meas})' if title == None else title
 
-    print("Computing figure...")
+def raster_brain_panel(ax, panel, hemi_colors, resol='fsaverage5', surf='pial'):
+    """
+    Render one panel (3D axes) of the static figure by rasterisation. Returns the (top, left) pixel position and the
+    RGBA pixels of the smallest box that holds the drawn brains (a layer for composite_panels).
+    """
+    meshes = [hemi_colors[hemi][0] for hemi, view in BRAIN_PANELS[panel]]
+    colors = np.concatenate([hemi_colors[hemi][1] for hemi, view in BRAIN_PANELS[panel]])
+    colors = np.vstack([np.round(colors * 255).astype(np.uint8), np.zeros((1, 4), dtype=np.uint8)])  # -1: empty
 
-    fig, axs = plt.subplot_mosaic('ABCDD..a.b;EFG.HH.a.b', figsize=(12, 7),
-                                  per_subplot_kw={('ABCDEFGH'): {'projection': '3d'}},
-                                  gridspec_kw=dict(wspace=0, hspace=0, width_ratios=[0.19, 0.19, 0.19, 0.02, 0.17,
-                                                                                     0.02, 0.08, 0.03, 0.01, 0.1]))
+    top, left, index = panel_face_index(ax, panel, meshes, resol=resol, surf=surf)
 
-    kargs = dict(sign_betas=sign_betas, fig=fig, surf='pial', resol=resol)
-    tkargs = dict(ha='center', va='center', style='italic', fontsize=10)
+    return top, left, colors[index]
+
+
+def composite_panels(fig, layers):
+    """Alpha-composite the rendered panels into one image, shown behind everything else in the figure."""
+    width, height = fig.canvas.get_width_height()
+    image = np.zeros((height, width, 4))
 
-    plot_single_brain(axs['A'], 'left', 'lateral', **kargs)
-    plot_single_brain(axs['B'], 'right', 'lateral', **kargs)
+    for top, left, pixels in layers:
+        src = pixels / 255.
+        dst = image[top:top + src.shape[0], left:left + src.shape[1]]
+        alpha = src[..., 3:] + dst[..., 3:] * (1 - src[..., 3:])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dst[..., :3] = np.where(alpha > 0, (src[..., :3] * src[..., 3:] +
+                                                dst[..., :3] * dst[..., 3:] * (1 - src[..., 3:])) / alpha, 0)
+        dst[..., 3:] = alpha
 
-    plot_single_brain(axs['C'], 'left', 'dorsal', **kargs)
-    plot_single_brain(axs['C'], 'right', 'dorsal', **kargs)
+    ax = fig.add_axes((0, 0, 1, 1), zorder=-1)
+    ax.imshow(image, extent=(0, 1, 0, 1), aspect='auto', interpolation='nearest')
+    ax.set_axis_off()
 
-    plot_single_brain(axs['D'], 'left', 'posterior', **kargs)
-    plot_single_brain(axs['D'], 'right', 'posterior', **kargs)
 
-    plot_single_brain(axs['E'], 'left', 'medial', **kargs)
-    plot_single_brain(axs['F'], 'right', 'medial', **kargs)
+def plot_brain_2d(sign_betas, all_observed_betas, 
+                 model, meas, resol='fsaverage5', title=None, dpi=100, engine=STATIC_ENGINE):
+    """
+    Static figure with 12 views of the brain. The face colours of each hemisphere are computed once. With the
+    'raster' engine, the 8 brain panels are rasterised and composited into the figure as one image (rendered at dpi,
+    so save the figure with the same dpi). With the 'matplotlib' engine, they are drawn in the figure one by one.
+    """
+    title = f'{model} ({meas})' if title == None else title
 
-    plot_single_brain(axs['G'], 'left', 'ventral', **kargs)
-    plot_single_brain(axs['G'], 'right', 'ventral', **kargs)
+    print("Computing figure...")
 
-    plot_single_brain(axs['H'], 'left', 'anterior', **kargs)
-    plot_single_brain(axs['H'], 'right', 'anterior', **kargs)
+    fig = plt.figure(figsize=(12, 7), dpi=dpi)
+    axs = brain_mosaic(fig)
 
-    axs['A'].set_ylim3d(-88, 90)
-    axs['B'].set_ylim3d(-88, 90)
+    # Surface and colours of each hemisphere, computed once for all views
+    hemi_colors = map_hemis(lambda hemi: hemi_face_colors(hemi, sign_betas, surf='pial', resol=resol))
 
-    axs['E'].set_ylim3d(-128, 50)
-    axs['F'].set_ylim3d(-128, 50)
+    if engine == 'raster':
+        layers = [raster_brain_panel(axs[panel], panel, hemi_colors, resol=resol) for panel in BRAIN_PANELS]
+        for panel in BRAIN_PANELS:
+            axs[panel].remove()
+        composite_panels(fig, layers)
+    else:
+        for panel in BRAIN_PANELS:
+            draw_brain_panel(axs[panel], panel, hemi_colors)
 
     plot_beta_colorbar_density(axs['a'], axs['b'], sign_betas, all_observed_betas)
     axs['a'].set_zorder(10) # Display label on top
@@ -0,0 +1,188 @@
+import os
+import json
+import argparse
+import warnings
+
+import numpy as np
+
+from definitions.backend_io import read_mgh, split_stack_name, PACK_FILENAME, PACK_MAGIC, PACK_ALIGN, open_pack
+from definitions.backend_calculations import summarise_term, term_summary
+
+# ===== PACKING RESULT DIRECTORIES =====================================================================================
+# Offline step that consolidates the .mgh maps of each model directory into a single result pack (see backend_io),
+# which detect_models, detect_terms and extract_results then read instead of the individual files.
+# Usage: python -m definitions.backend_store <results_directory> [--remove-originals]
+# With --summaries-only, only the term summaries (see backend_io) are precomputed, and the maps are left as they are.
+
+
+def pack_model_directory(mdir, remove_originals=False):
+    """
+    Consolidate all the (*.coef.mgh and *.ocn.mgh) maps and the stack_names.txt of a model directory into one result
+    pack. Returns the path to the pack or None if the directory contains no maps.
+    """
+    # Group maps into series of stacks (e.g. all 'lh.area.stack{}.coef.mgh' files)
+    series = {}
+    for file_name in os.listdir(mdir):
+        if not (file_name.endswith('coef.mgh') or file_name.endswith('ocn.mgh')):
+            continue
+        name, stack = split_stack_name(file_name)
+        if name is None:
+            warnings.warn(f'Skipping {file_name}: no stack number in file name.')
+            continue
+        series.setdefault(name, {})[stack] = file_name
+
+    if not series:
+        return None
+
+    header = {'series': {}, 'stack_names': None, 'summaries': {}}
+
+    stack_file = os.path.join(mdir, 'stack_names.txt')
+    if os.path.isfile(stack_file):
+        with open(stack_file) as f:
+            header['stack_names'] = f.read()
+
+    # Read all maps (once) into one vertex x stack matrix per series
+    matrices = {}
+    for name, files in sorted(series.items()):
+        stacks = sorted(files)
+        # (mtime, size) of each map when read, so the pack is not used for maps changed since (see ResultPack)
+        stats = [os.stat(os.path.join(mdir, files[stack])) for stack in stacks]
+        sources = [[st.st_mtime_ns, st.st_size] for st in stats]
+        maps = [read_mgh(os.path.join(mdir, files[stack]), mmap=False) for stack in stacks]
+        matrix = np.column_stack(maps)
+        matrix = matrix.astype(matrix.dtype.newbyteorder('<'), copy=False)
+
+        matrices[name] = matrix
+        header['series'][name] = dict(stacks=stacks, shape=list(matrix.shape), dtype=matrix.dtype.str, sources=sources)
+
+    # Precompute cluster summaries for each term that has both its cluster and beta map
+    for name, matrix in matrices.items():
+        if not name.endswith('coef.mgh'):
+            continue
+        ocn_name = name.replace('coef.mgh', 'cache.th30.abs.sig.ocn.mgh')
+        if ocn_name not in matrices:
+            continue
+        ocn_stacks = header['series'][ocn_name]['stacks']
+        for i, stack in enumerate(header['series'][name]['stacks']):
+            if stack in ocn_stacks:
+                header['summaries'][name.format(stack)] = summarise_term(
+                    matrices[ocn_name][:, ocn_stacks.index(stack)], matrix[:, i])
+
+    # Lay out the data blocks (the header length depends on the offsets, so iterate until it is stable)
+    offset = 0
+    while True:
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_start = -(-(len(PACK_MAGIC) + 8 + len(header_bytes)) // PACK_ALIGN) * PACK_ALIGN
+        pos = data_start
+        for name, matrix in matrices.items():
+            header['series'][name]['offset'] = pos
+            pos += -(-matrix.nbytes // PACK_ALIGN) * PACK_ALIGN
+        if data_start == offset:
+            break
+        offset = data_start
+
+    pack_path = os.path.join(mdir, PACK_FILENAME)
+    tmp_path = f'{pack_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(PACK_MAGIC)
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for name, matrix in matrices.items():
+            f.write(b'\0' * (header['series'][name]['offset'] - f.tell()))
+            f.write(np.asfortranarray(matrix).tobytes(order='F'))
+    os.replace(tmp_path, pack_path)  # never leave a half-written pack behind
+
+    if remove_originals:
+        for files in series.values():
+            for file_name in files.values():
+                os.remove(os.path.join(mdir, file_name))
+        if header['stack_names'] is not None:
+            os.remove(stack_file)
+
+    return pack_path
+
+
+def summarise_model_directory(mdir):
+    """Write the summary sidecar of a model directory (see backend_io), for every term with a cluster and beta map."""
+    pack = open_pack(mdir)
+    file_names = set(os.listdir(mdir)) | set(pack.members() if pack is not None else [])
+
+    summarised = []
+    for coef_name in sorted(f for f in file_names if f.endswith('.coef.mgh')):
+        ocn_name = coef_name.replace('coef.mgh', 'cache.th30.abs.sig.ocn.mgh')
+        if ocn_name in file_names:
+            term_summary(mdir, ocn_name, coef_name)
+            summarised.append(coef_name)
+
+    return summarised
+
+
+def summarise_results_directory(resdir):
+    """Write the summary sidecars of every (sub)directory of a results directory that contains result maps."""
+    mdirs = []
+    for root, dirs, filenames in os.walk(resdir):
+        if any(f.endswith('coef.mgh') or f == PACK_FILENAME for f in filenames):
+            summarise_model_directory(root)
+            mdirs.append(root)
+    return mdirs
+
+
+def index_results_directory(resdir, resformat='verywise', masks=True, vertex_tables=False):
+    """
+    Build (and store) the significance mask index and / or the vertex tables (see vertex_table) of every model /
+    measure of a results directory.
+    """
+    from definitions.backend_calculations import detect_models, detect_terms, significance_index, vertex_table
+
+    all_results = detect_models(resdir, results_format=resformat)
+
+    indexed = []
+    for group, group_df in sorted(all_results['results'].items()):
+        for model in sorted(group_df.model.unique()):
+            for meas in sorted(group_df.loc[group_df.model == model, 'meas'].unique()):
+                if masks:
+                    significance_index(all_results, f'{group}/{model}', meas)
+                if vertex_tables:
+                    for hemi in ['left', 'right']:
+                        vertex_table(all_results, f'{group}/{model}', meas, hemi)
+                indexed.append((f'{group}/{model}', meas, len(detect_terms(all_results, f'{group}/{model}', meas))))
+    return indexed
+
+
+def pack_results_directory(resdir, remove_originals=False):
+    """Pack every (sub)directory of a results directory that contains result maps."""
+    packs = []
+    for root, dirs, filenames in os.walk(resdir):
+        if any(f.endswith('coef.mgh') for f in filenames):
+            packs.append(pack_model_directory(root, remove_originals=remove_originals))
+    return packs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Consolidate verywise/QDECR result maps into result packs.')
+    parser.add_argument('resdir', help='Results directory')
+    parser.add_argument('--remove-originals', action='store_true',
+                        help='Delete the .mgh files (and stack_names.txt) once they are packed')
+    parser.add_argument('--summaries-only', action='store_true',
+                        help='Only write the term summary sidecars (and leave the .mgh files unpacked)')
+    parser.add_argument('--mask-index', action='store_true',
+                        help='Also build the significance mask index of every model and measure')
+    parser.add_argument('--vertex-tables', action='store_true',
+                        help='Also build the vertex tables (betas and clusters of all terms per vertex) of every model '
+                             'and measure')
+    parser.add_argument('--format', default='verywise', choices=['verywise', 'QDECR'],
+                        help='Results format (for --mask-index and --vertex-tables)')
+    args = parser.parse_args()
+
+    if args.summaries_only:
+        for mdir in summarise_results_directory(args.resdir):
+            print(f'Summarised {mdir}')
+    else:
+        for pack in pack_results_directory(args.resdir, remove_originals=args.remove_originals):
+            print(f'Packed {pack}')
+
+    if args.mask_index or args.vertex_tables:
+        for which_model, meas, n_terms in index_results_directory(args.resdir, resformat=args.format,
+                                                                  masks=args.mask_index,
+                                                                  vertex_tables=args.vertex_tables):
+            print(f'Indexed {which_model} ({meas}): {n_terms} terms')
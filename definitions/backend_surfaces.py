@@ -0,0 +1,306 @@
+import os
+import warnings
+import threading
+from collections import namedtuple
+from collections.abc import Mapping
+
+import numpy as np
+
+from definitions.backend_io import SHARED_CACHE_DIR, file_lock, save_array
+
+# ===== FSAVERAGE SURFACE REGISTRY =====================================================================================
+# Each fsaverage mesh (and sulcal depth map) is loaded once per process into compact float32 / int32 arrays and shared
+# by all plotting functions. Optionally, the arrays are also stored as .npy files in VWW_SURFACE_CACHE_DIR (by default
+# the surfaces folder of the shared cache directory, see backend_io) and memory-mapped from there by all other
+# processes, so app workers share one copy of each mesh.
+
+# Size / number of nodes per map
+N_NODES = {'fsaverage': 163842,
+           'fsaverage6': 40962,
+           'fsaverage5': 10242}
+
+SURFACE_TYPES = ('pial', 'infl', 'flat', 'sphere')
+
+SURFACE_CACHE_DIR = os.environ.get('VWW_SURFACE_CACHE_DIR',
+                                   os.path.join(SHARED_CACHE_DIR, 'surfaces') if SHARED_CACHE_DIR else None)
+
+# Mesh geometry, accepted by nilearn wherever a mesh file is (same fields as nilearn.surface.Mesh)
+Mesh = namedtuple('Mesh', ['coordinates', 'faces'])
+
+_SURFACES = {}
+_LOCK = threading.Lock()
+
+
+def _cache_files(resolution, key, is_mesh):
+    parts = ('coordinates', 'faces') if is_mesh else ('data',)
+    return [os.path.join(SURFACE_CACHE_DIR, f'{resolution}_{key}_{part}.npy') for part in parts]
+
+
+def _read_surface(resolution, key):
+    """Read one mesh (e.g. 'pial_left') or background map (e.g. 'sulc_left') into compact arrays."""
+    is_mesh = key.split('_')[0] in SURFACE_TYPES
+
+    if SURFACE_CACHE_DIR is None:
+        arrays = _load_surface(resolution, key, is_mesh)
+    else:
+        cache_files = _cache_files(resolution, key, is_mesh)
+        if not all(os.path.isfile(f) for f in cache_files):
+            os.makedirs(SURFACE_CACHE_DIR, exist_ok=True)
+            with file_lock(cache_files[0]):  # only one process loads (or downloads) the surface
+                if not all(os.path.isfile(f) for f in cache_files):
+                    for array, cache_file in zip(_load_surface(resolution, key, is_mesh), cache_files):
+                        save_array(cache_file, array)
+
+        arrays = [np.load(f, mmap_mode='r') for f in cache_files]
+
+    return Mesh(*arrays) if is_mesh else arrays[0]
+
+
+def _load_surface(resolution, key, is_mesh):
+    """Load the arrays of one mesh (coordinates and faces) or background map from the nilearn fsaverage files."""
+    from nilearn import datasets, surface
+
+    fs_avg = datasets.fetch_surf_fsaverage(mesh=resolution)
+
+    if is_mesh:
+        mesh = surface.load_surf_mesh(fs_avg[key])
+        arrays = [np.ascontiguousarray(mesh.coordinates, dtype=np.float32),
+                  np.ascontiguousarray(mesh.faces, dtype=np.int32)]
+    else:
+        arrays = [np.ascontiguousarray(surface.load_surf_data(fs_avg[key]), dtype=np.float32)]
+
+    for array in arrays:
+        array.setflags(write=False)
+
+    return arrays
+
+
+def get_surface(resolution, key):
+    """Mesh or background map of one resolution, loaded on first use."""
+    if (resolution, key) not in _SURFACES:
+        with _LOCK:
+            if (resolution, key) not in _SURFACES:
+                _SURFACES[(resolution, key)] = _read_surface(resolution, key)
+    return _SURFACES[(resolution, key)]
+
+
+class FsaverageSurfaces(Mapping):
+    """
+    Drop-in replacement for the output of nilearn.datasets.fetch_surf_fsaverage (keys such as 'pial_left' or
+    'sulc_right'), that returns the in-memory arrays instead of paths to the mesh files.
+    """
+
+    def __init__(self, resolution):
+        if resolution not in N_NODES:
+            raise ValueError(f'Unknown resolution: {resolution}')
+        self.resolution = resolution
+        self.n_nodes = N_NODES[resolution]
+
+    def __getitem__(self, key):
+        if key not in self._keys():
+            raise KeyError(key)
+        return get_surface(self.resolution, key)
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    @staticmethod
+    def _keys():
+        return [f'{s}_{hemi}' for s in SURFACE_TYPES + ('sulc',) for hemi in ('left', 'right')]
+
+
+# ===== LEVELS OF DETAIL ===============================================================================================
+# The fsaverage meshes are recursively subdivided icosahedra: the first 10 * 4 ** k + 2 vertices of any fsaverage mesh
+# are the vertices of its order-k icosahedron (hence fsaverage5 = order 5). Coarser meshes (levels of detail) are
+# obtained exactly by undoing the subdivisions, and a map on the finer mesh is shown on them by its first values.
+
+ICO_ORDER = {'fsaverage': 7,
+             'fsaverage6': 6,
+             'fsaverage5': 5}
+
+_LOD_SURFACES = {}
+
+
+def ico_nodes(order):
+    """Number of vertices of the order-k icosahedron (i.e. of each hemisphere of fsaverage<k>)."""
+    return 10 * 4 ** order + 2
+
+
+def midpoint_ends(faces, n_coarse):
+    """
+    The two coarse vertices (ends of the edge it split) of each vertex added by the last subdivision of a mesh, i.e.
+    of vertices n_coarse, n_coarse + 1, ... Returns an array of shape (n_vertices - n_coarse, 2).
+    """
+    faces = np.asarray(faces)
+    corners = faces[(faces < n_coarse).sum(axis=1) == 1]  # faces with one coarse vertex and two midpoints
+
+    vertex = corners.max(axis=1, where=corners < n_coarse, initial=-1)
+    pairs = np.concatenate([np.stack([corners[:, i], vertex], axis=1) for i in range(3)])
+    pairs = np.unique(pairs[pairs[:, 0] >= n_coarse], axis=0)  # sorted by midpoint, two ends each
+
+    return pairs[:, 1].reshape(-1, 2)
+
+
+def decimate_faces(faces, n_coarse):
+    """
+    Faces of the next coarser icosahedron (with the first n_coarse vertices), from the faces of a subdivided one.
+    Each coarse face was split into three corner faces (one coarse vertex and two edge midpoints) and a central face:
+    the corners are kept and their midpoints replaced by the other end of their edge.
+    """
+    faces = np.asarray(faces)
+    corners = faces[(faces < n_coarse).sum(axis=1) == 1]
+
+    # Rotate each corner face (keeping its orientation) so that its coarse vertex comes first
+    shift = np.argmax(corners < n_coarse, axis=1)
+    corners = np.take_along_axis(corners, (np.arange(3) + shift[:, None]) % 3, axis=1)
+
+    ends = midpoint_ends(faces, n_coarse).sum(axis=1)
+    vertex, mid_a, mid_b = corners.T
+    coarse = np.stack([vertex, ends[mid_a - n_coarse] - vertex, ends[mid_b - n_coarse] - vertex], axis=1)
+
+    # Each coarse face appears once per corner: keep the one starting with its lowest vertex
+    return np.ascontiguousarray(coarse[(vertex < coarse[:, 1]) & (vertex < coarse[:, 2])], dtype=np.int32)
+
+
+def get_lod_surface(resolution, key, order):
+    """Mesh (e.g. 'pial_left') of a resolution, decimated to the order-k icosahedron (computed once)."""
+    if order >= ICO_ORDER[resolution]:
+        return get_surface(resolution, key)
+
+    if (resolution, key, order) not in _LOD_SURFACES:
+        coordinates, faces = get_surface(resolution, key)
+        for k in range(ICO_ORDER[resolution] - 1, order - 1, -1):
+            faces = decimate_faces(faces, ico_nodes(k))
+        _LOD_SURFACES[(resolution, key, order)] = Mesh(coordinates[:ico_nodes(order)], faces)
+
+    return _LOD_SURFACES[(resolution, key, order)]
+
+
+# ===== DOWNSAMPLING ===================================================================================================
+# Maps are shown on lower resolutions through a sparse resampling operator, computed once per (source resolution,
+# target resolution, hemisphere): each coarse vertex summarises its own patch of the finer mesh (itself and half of
+# each midpoint on its edges, recursively), weighted by the area of the vertices on the pial surface.
+# The operator needs the mesh of the source resolution. If it cannot be loaded (e.g. downloaded), maps are sampled at
+# the vertices the two resolutions share instead, with a warning: the patches are not summarised, so e.g. clusters
+# smaller than the coarse mesh spacing may not be shown.
+
+_OPERATORS = {}
+_OPERATOR_LOCK = threading.Lock()
+
+
+def vertex_areas(coordinates, faces):
+    """Area of each vertex: a third of the area of its faces."""
+    tri = np.asarray(coordinates, dtype=np.float64)[faces]
+    face_areas = np.linalg.norm(np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0]), axis=1) / 2
+    return np.bincount(np.asarray(faces).ravel(), weights=np.repeat(face_areas, 3), minlength=len(coordinates)) / 3
+
+
+def _resampling_operator(source, target, hemi, surf='pial'):
+    """Row-normalised (target x source nodes) sparse operator, built by undoing one subdivision at a time."""
+    from scipy import sparse
+
+    coordinates, faces = get_surface(source, f'{surf}_{hemi}')
+    operator = None
+
+    for order in range(ICO_ORDER[source], ICO_ORDER[target], -1):
+        n_fine, n_coarse = ico_nodes(order), ico_nodes(order - 1)
+        areas = vertex_areas(coordinates[:n_fine], faces)
+        ends = midpoint_ends(faces, n_coarse)
+
+        midpoints = np.arange(n_coarse, n_fine)
+        rows = np.concatenate([np.arange(n_coarse), ends[:, 0], ends[:, 1]])
+        cols = np.concatenate([np.arange(n_coarse), midpoints, midpoints])
+        weights = np.concatenate([areas[:n_coarse], areas[n_coarse:] / 2, areas[n_coarse:] / 2])
+
+        step = sparse.csr_matrix((weights, (rows, cols)), shape=(n_coarse, n_fine))
+        step = sparse.diags(1 / np.asarray(step.sum(axis=1)).ravel()) @ step
+        operator = step if operator is None else step @ operator
+
+        faces = decimate_faces(faces, n_coarse)
+
+    return operator.tocsr()
+
+
+def resampling_operator(source, target, hemi, surf='pial'):
+    """
+    Sparse operator from maps on the source resolution to the target resolution (computed once, and stored in
+    SURFACE_CACHE_DIR when set).
+    """
+    from scipy import sparse
+
+    key = (source, target, hemi, surf)
+    if key in _OPERATORS:
+        return _OPERATORS[key]
+
+    with _OPERATOR_LOCK:
+        if key not in _OPERATORS:
+            if SURFACE_CACHE_DIR is None:
+                _OPERATORS[key] = _resampling_operator(*key)
+            else:
+                parts = ('data', 'indices', 'indptr')
+                cache_files = [os.path.join(SURFACE_CACHE_DIR, f'{source}_to_{target}_{surf}_{hemi}_{part}.npy')
+                               for part in parts]
+                if not all(os.path.isfile(f) for f in cache_files):
+                    os.makedirs(SURFACE_CACHE_DIR, exist_ok=True)
+                    with file_lock(cache_files[0]):
+                        if not all(os.path.isfile(f) for f in cache_files):
+                            operator = _resampling_operator(*key)
+                            for part, cache_file in zip(parts, cache_files):
+                                save_array(cache_file, getattr(operator, part))
+
+                data, indices, indptr = [np.load(f, mmap_mode='r') for f in cache_files]
+                _OPERATORS[key] = sparse.csr_matrix((data, indices, indptr), shape=(N_NODES[target], N_NODES[source]))
+
+    return _OPERATORS[key]
+
+
+def downsample_map(values, resolution, hemi, how='mean'):
+    """
+    Map of one hemisphere on a (lower) resolution. how='mean': area-weighted mean of the non-missing values of each
+    coarse vertex's patch (missing only if the whole patch is), for continuous maps; how='max': largest value of the
+    patch, for labels (e.g. clusters), so that small clusters are not lost. Maps already at the resolution are
+    returned as they are. Without the source mesh, the map is sampled at the shared vertices (see above).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n_nodes = N_NODES[resolution]
+    source = {n: res for res, n in N_NODES.items()}.get(len(values))
+
+    if len(values) == n_nodes or source is None or N_NODES[source] < n_nodes:
+        return values[:n_nodes]
+
+    try:
+        operator = resampling_operator(source, resolution, hemi)
+    except OSError as e:  # e.g. no connection to download the source mesh
+        warnings.warn(f'Could not load the {source} {hemi} mesh ({e}): maps are shown on {resolution} by their values '
+                      f'at its vertices only, without summarising the {source} vertices around them.')
+        _OPERATORS[(source, resolution, hemi, 'pial')] = operator = None  # not tried again by this process
+
+    if operator is None:
+        return values[:n_nodes]  # the first n_nodes vertices of the source mesh are the vertices of the target one
+
+    if how == 'max':
+        return np.fmax.reduceat(values[operator.indices], operator.indptr[:-1])
+
+    valid = ~np.isnan(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (operator @ np.where(valid, values, 0)) / (operator @ valid)
+
+
+def warm_surfaces(resolutions=('fsaverage5', 'fsaverage6'), surfaces=('pial', 'sulc'), background=True):
+    """Pre-load surfaces (e.g. at app startup), by default in a background thread."""
+    def warm():
+        for resolution in resolutions:
+            for key in surfaces:
+                for hemi in ('left', 'right'):
+                    try:
+                        get_surface(resolution, f'{key}_{hemi}')
+                    except Exception as e:  # e.g. no connection to download the mesh: load it on first use
+                        warnings.warn(f'Could not pre-load {resolution} {key}_{hemi} surface: {e}')
+
+    if background:
+        threading.Thread(target=warm, daemon=True).start()
+    else:
+        warm()
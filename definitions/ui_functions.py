@@ -1,15 +1,155 @@
-from shiny import Inputs, Outputs, Session, module, reactive, render, ui
+from shiny import Inputs, Outputs, Session, module, reactive, render, req, ui
 
 from shinywidgets import output_widget, render_plotly
 
 import io
+import os
+import time
+import queue
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import definitions.layout_styles as styles
-from definitions.backend_calculations import detect_terms, extract_results
-from definitions.backend_dynamic_plots import plot_surfmap
-from definitions.backend_static_plots import beta_colorbar_density_figure, clusterwise_means_figure, plot_brain_2d
+from definitions.backend_calculations import detect_terms, extract_results, count_term_clusters, vertex_tables, \
+    query_vertex
+from definitions.backend_dynamic_plots import surfmap_colors, brain_figure, update_brain_colors, update_brain_mesh, \
+    auto_resolution, preview_order, lod_colors, LOD_REFINE_DELAY
+from definitions.backend_surfaces import warm_surfaces
+from definitions.backend_io import map_hemis
 
 
+# The plotting modules (matplotlib, plotly, pandas, nilearn) are only imported when first needed, so that new app
+# workers serve the welcome page quickly. Shortly after the first session starts, they are imported (and the default
+# meshes loaded) in the background, to be ready for the first plots.
+WARM_UP_DELAY = 2  # seconds
+
+_WARM_UP_STARTED = threading.Event()
+
+
+def warm_up(delay=WARM_UP_DELAY):
+    """Import the plotting modules and load the meshes of the default resolution in the background (once)."""
+    if _WARM_UP_STARTED.is_set():
+        return
+    _WARM_UP_STARTED.set()
+
+    def warm():
+        import pandas  # noqa: F401
+        import plotly.graph_objects  # noqa: F401
+        import definitions.backend_static_plots  # noqa: F401 (matplotlib, pyplot and mplot3d)
+        warm_surfaces(background=False)
+
+    timer = threading.Timer(delay, warm)
+    timer.daemon = True
+    timer.start()
+
+
+RESOLUTION_CHOICES = {'auto': 'Auto (fit to this device)', 'fsaverage': 'High (164k nodes)',
+                      'fsaverage6': 'Medium (50k nodes)', 'fsaverage5': 'Low (10k modes)'}
+
+
+def html_table(df, float_format='{:.4f}'.format):
+    """
+    A table as shown by render.table, but rendered with DataFrame.to_html: render.table imports pandas' Styler, which
+    needs Jinja2 (not a dependency of the app).
+    """
+    return ui.HTML(df.to_html(index=False, classes='table shiny-table w-auto', border=0, float_format=float_format,
+                              na_rep=''))
+
+
+def resolve_resolution(resolution, session):
+    """The selected resolution, or for 'auto' the one that fits the browser (from its benchmark, see app.py)."""
+    if resolution != 'auto':
+        return resolution
+    root_input = session.root_scope().input
+    return auto_resolution(root_input.client_benchmark() if 'client_benchmark' in root_input else None)
+
+
+# Results are loaded by a pool of background threads (NumPy, file I/O and the drawing of the legend release the GIL
+# for most of the work), so that sessions stay responsive while a (high resolution) result loads. Each stage is handed
+# to the session as soon as it is ready, and loads superseded by a newer update stop at their next stage.
+LOAD_WORKERS = int(os.environ.get('VWW_LOAD_WORKERS', 4))
+LOAD_POLL_INTERVAL = 0.1  # seconds between checks of a session for newly loaded stages
+
+_LOAD_POOL = ThreadPoolExecutor(max_workers=LOAD_WORKERS, thread_name_prefix='vwwizard-load')
+
+
+class LoadCancelled(Exception):
+    """Raised in a load that was superseded by a newer one."""
+
+
+def load_single_result(params, stage, superseded):
+    """
+    Load one result (params: model, term, measure, resdir, resformat, output, surface, resolution) in stages, handing
+    each to stage(name, value) as soon as it is ready: 'info' (message), 'maps' (betas, for the download), 'left' and
+    'right' ((mesh key, vertex colors), or (None, None) without clusters) and 'legend' (figure).
+    Raises LoadCancelled at the next stage once superseded() returns True.
+    """
+    from definitions.backend_static_plots import beta_colorbar_density_figure, clusterwise_means_figure
+
+    def put(name, value):
+        if superseded():
+            raise LoadCancelled()
+        stage(name, value)
+
+    if superseded():
+        raise LoadCancelled()
+
+    # Extract results
+    min_beta, max_beta, mean_beta, n_clusters, sign_clusters, sign_betas, all_betas, stats = extract_results(
+        which_model=params['model'],
+        which_term=params['term'],
+        which_meas=params['measure'],
+        resdir=params['resdir'],
+        resformat=params['resformat'],
+        return_stats=True)
+
+    l_nc = int(n_clusters[0])
+    r_nc = int(n_clusters[1])
+
+    put('maps', (sign_betas, all_betas, params))
+
+    if l_nc == r_nc == 0:
+        put('info', ui.markdown(
+            f'**0** clusters identified (in the left or the right hemisphere).'))
+        put('left', (None, None))
+        put('right', (None, None))
+        put('legend', None)
+        return
+
+    put('info', ui.markdown(
+        f'**{l_nc + r_nc}** clusters identified ({l_nc} in the left and {r_nc} in the right hemisphere).<br />'
+        f'Mean beta value [range] = **{mean_beta:.2f}** [{min_beta:.2f}; {max_beta:.2f}]'))
+
+    # The brain meshes only need to be (re-)sent to the browser when the surface or resolution change
+    brain_mesh_key = (params['surface'], params['resolution'])
+
+    def color_brain(hemi):  # both hemispheres concurrently, each handed over as soon as it is ready
+        brain_colors = surfmap_colors(
+            min_beta, max_beta, n_clusters, sign_clusters, sign_betas,
+            resol=params['resolution'],
+            output=params['output'],
+            hemis=[hemi])
+        put(hemi, (brain_mesh_key, brain_colors[hemi]))
+
+    map_hemis(color_brain)
+
+    if params['output'] == 'betas':
+        legend_plot = beta_colorbar_density_figure(sign_betas, all_betas,
+                                                   figsize=(4, 6),
+                                                   colorblind=False,
+                                                   set_range=None,
+                                                   cache_key=(str(params['resdir']), params['model'], params['term'],
+                                                              params['measure']),
+                                                   summaries=[stats[h]['summary'] for h in stats])
+    else:
+        legend_plot = clusterwise_means_figure(sign_clusters, sign_betas,
+                                               figsize=(4, 6),
+                                               cmap=styles.CLUSTER_COLORMAP,
+                                               tot_clusters=int(n_clusters[0]+n_clusters[1]),
+                                               stats=stats)
+    put('legend', legend_plot)
+
 # ------------------------------------------------------------------------------
 # Define the UI and server for the WELCOME tab
 # ------------------------------------------------------------------------------
@@ -31,6 +171,8 @@ def welcome_page(start_folder, tab_name):
                         '&emsp;⇢ *A directory inside a (public) github repository*</br>'
                         '&emsp;&emsp;[this is most flexible but it requires loading all '
                         'results before getting started so it may take a minute]</br>'
+                        '&emsp;⇢ *A path or link to a `.zip` / `.tar.gz` archive of the results folder*</br>'
+                        '&emsp;&emsp;[this is the fastest way to load results that are hosted online]</br>'
                         'A word of advice? If you have *a lot* of result files (e.g. you have run a '
                         'bunch of models or models with lots of covariates) you are probably better '
                         'off downloading them and running the app "offline". See the instructions on '
@@ -92,9 +234,18 @@ def describe_input_folder(model_dict, selected_folder):
 
             avail_hemi_text = f'</br>{tab_spacing}'.join(hemi_rows)
 
+            # Number of significant clusters per term (only when precomputed in the term summaries)
+            cluster_rows = []
+            for sub_meas in avail_meas:
+                counts = count_term_clusters(model_dict, f'{dir}/{sub_model}', sub_meas)
+                cluster_rows.append(', '.join(f'{term}: **{n}**' for term, n in counts.items()))
+
+            avail_cluster_text = f'</br>{tab_spacing}'.join(cluster_rows)
+
             sub_table = f'<td VALIGN=TOP>{tab_spacing}{sub_model}</td>' \
                         f'<td VALIGN=TOP>{tab_spacing}{avail_meas_text}</td>' \
-                        f'<td VALIGN=TOP>{tab_spacing}{avail_hemi_text}</td></tr>'
+                        f'<td VALIGN=TOP>{tab_spacing}{avail_hemi_text}</td>' \
+                        f'<td VALIGN=TOP>{tab_spacing}{avail_cluster_text}</td></tr>'
 
             sub_text = sub_text + sub_table
 
@@ -102,7 +253,8 @@ def describe_input_folder(model_dict, selected_folder):
 
     folder_info = ui.markdown(
         f'You have selected the directory: `{selected_folder}`</br></br>'
-        f'This folder contains the following models:{info_text}</br></br>'
+        f'This folder contains the following models (with the number of significant clusters of each term, '
+        f'where these were already computed):{info_text}</br></br>'
         f'Now, you can navigate to the **"Main results"** tab to choose which maps you would like to see. '
         f'If you select *two* maps on the Main results page, you can also see their overlap by navigating to the '
         f'**"Overlap"** tab.')
@@ -152,7 +304,7 @@ def single_result_ui():
     resolution_choice = ui.input_selectize(
         id='select_resolution',
         label='Resolution',
-        choices={'fsaverage': 'High (164k nodes)', 'fsaverage6': 'Medium (50k nodes)', 'fsaverage5': 'Low (10k modes)'},
+        choices=RESOLUTION_CHOICES,
         selected='fsaverage6')
 
     # Buttons
@@ -193,6 +345,12 @@ def single_result_ui():
                     full_screen=True),
             ui.output_plot('color_legend'),
             col_widths=(4, 4, 4)
+        ),
+        # Selected vertex (clicked on one of the brains)
+        ui.layout_columns(
+            ui.card(ui.output_ui('vertex_info'),
+                    ui.output_ui('vertex_table')),
+            col_widths=(8, -4)
         ))
 
 @module.server
@@ -258,88 +416,192 @@ def update_single_result(input: Inputs, output: Outputs, session: Session,
             label='Choose term',
             choices=avail_terms)
 
-    @reactive.Calc
-    @reactive.event(input.update_button, ignore_none=True)
-    def single_result_output():
-        with ui.Progress(min=1, max=6) as p:
-
-            p.set(1, message="Loading results...")
-
-            # Extract results
-            min_beta, max_beta, mean_beta, n_clusters, sign_clusters, sign_betas, all_betas = extract_results(
-                which_model=input.select_model(),
-                which_term=input.select_term(),
-                which_meas=input.select_measure(),
-                resdir=input_resdir(),
-                resformat=input_resformat())
-
-            p.set(2, message="Calculating maps...")
-
-            l_nc = int(n_clusters[0])
-            r_nc = int(n_clusters[1])
+    # Results are loaded in the background (see load_single_result): each update starts a new load (superseding the
+    # previous one), and the stages it hands over are polled for and shown as they arrive
+    loaded = {name: reactive.Value(None) for name in ['info', 'maps', 'left', 'right', 'legend', 'error']}
+    load = dict(generation=0, stages=None, future=None)
+    load_started = reactive.Value(0)
 
-            if l_nc == r_nc == 0:
-                info = ui.markdown(
-                    f'**0** clusters identified (in the left or the right hemisphere).')
-                brains = {'left': None, 'right': None}
-                legend_plot = None
+    def stop_loading():
+        load['generation'] += 1
+        if load['future'] is not None:
+            load['future'].cancel()  # if it did not start yet
 
-            else:
-                info = ui.markdown(
-                    f'**{l_nc + r_nc}** clusters identified ({l_nc} in the left and {r_nc} in the right hemisphere).<br />'
-                    f'Mean beta value [range] = **{mean_beta:.2f}** [{min_beta:.2f}; {max_beta:.2f}]')
+    session.on_ended(stop_loading)
 
-                p.set(3, message="Calculating maps...")
-
-                brains = plot_surfmap(
-                    min_beta, max_beta, n_clusters, sign_clusters, sign_betas,
-                    surf=input.select_surface(),
-                    resol=input.select_resolution(),
-                    output=input.select_output())
-
-                p.set(4, message="Rendering brains...")
-
-                if input.select_output() == 'betas':
-                    legend_plot = beta_colorbar_density_figure(sign_betas, all_betas,
-                                                             figsize=(4, 6),
-                                                             colorblind=False,
-                                                             set_range=None)
-                else:
-                    legend_plot = clusterwise_means_figure(sign_clusters, sign_betas,
-                                                           figsize=(4, 6),
-                                                           cmap=styles.CLUSTER_COLORMAP,
-                                                           tot_clusters=int(n_clusters[0]+n_clusters[1]))
-
-                p.set(5, message="...almost done!")
-
-        return info, brains, legend_plot, sign_betas, all_betas
+    @reactive.Effect
+    @reactive.event(input.update_button, ignore_none=True)
+    def start_loading():
+        stop_loading()
+        generation = load['generation']
+
+        params = dict(model=input.select_model(), term=input.select_term(), measure=input.select_measure(),
+                      resdir=input_resdir(), resformat=input_resformat(), output=input.select_output(),
+                      surface=input.select_surface(),
+                      resolution=resolve_resolution(input.select_resolution(), session))
+        stages = queue.SimpleQueue()
+        load.update(stages=stages,
+                    future=_LOAD_POOL.submit(load_single_result, params, lambda name, value: stages.put((name, value)),
+                                             lambda: load['generation'] != generation))
+
+        loaded['info'].set(ui.markdown('Loading results...'))
+        loaded['error'].set(None)
+        load_started.set(generation)
+
+    @reactive.Effect
+    def receive_loaded_stages():
+        load_started()
+        stages, future = load['stages'], load['future']
+        if future is None:
+            return
+
+        done = future.done()  # checked first, so that the stages handed over before it finished are all received
+        while not stages.empty():
+            name, value = stages.get()
+            loaded[name].set(value)
+            if name in brain_mesh_keys:
+                with reactive.isolate():
+                    if value[0] != brain_mesh_keys[name]():
+                        brain_mesh_keys[name].set(value[0])
+
+        if not done:
+            reactive.invalidate_later(LOAD_POLL_INTERVAL)
+        elif not future.cancelled():
+            error = future.exception()
+            if error is not None and not isinstance(error, LoadCancelled):
+                loaded['error'].set(error)  # shown in the info output
 
     @render.text
     def info():
-        md_info = single_result_output()[0]
-        return md_info
+        if loaded['error']() is not None:
+            raise loaded['error']()
+        req(loaded['info']())
+        return loaded['info']()
+
+    # Brain widgets persist across updates: they are only re-rendered when the surface or resolution change (first
+    # with a decimated preview of fine meshes, refined shortly after), otherwise only their vertex colors are patched
+    brain_mesh_keys = {hemi: reactive.Value(None) for hemi in ['left', 'right']}
+    brain_widgets = {}  # hemi: (widget, mesh key, colors shown, level of detail shown (None: full mesh), render time)
+
+    def render_brain(hemi):
+        mesh_key = brain_mesh_keys[hemi]()
+        if mesh_key is None:
+            brain_widgets.pop(hemi, None)
+            return None
+
+        with reactive.isolate():
+            colors = loaded[hemi]()[1]
+
+        order = preview_order(mesh_key[1])
+        widget = brain_figure(*mesh_key, hemi, *colors, widget=True, order=order, clickable=True)
+        widget.data[0].on_click(functools.partial(select_vertex, hemi))
+        brain_widgets[hemi] = (widget, mesh_key, colors, order, time.monotonic())
+
+        return widget
+
+    @reactive.Effect
+    def refine_brain_meshes():
+        pending = False
+        for hemi in ['left', 'right']:
+            mesh_key = brain_mesh_keys[hemi]()
+            if mesh_key is None or preview_order(mesh_key[1]) is None:
+                continue
+            if hemi not in brain_widgets or brain_widgets[hemi][1] != mesh_key:
+                pending = True  # not rendered yet
+                continue
+
+            widget, widget_mesh_key, colors, order, rendered = brain_widgets[hemi]
+            if order is None:
+                continue
+            if time.monotonic() - rendered < LOD_REFINE_DELAY:  # let the browser show the preview first
+                pending = True
+                continue
+
+            update_brain_mesh(widget, *mesh_key, hemi, *colors)
+            brain_widgets[hemi] = (widget, widget_mesh_key, colors, None, rendered)
+
+        if pending:
+            reactive.invalidate_later(LOD_REFINE_DELAY / 4)
+
+    @reactive.Effect
+    def patch_brain_colors():
+        for hemi in ['left', 'right']:
+            if loaded[hemi]() is None or hemi not in brain_widgets:
+                continue
+
+            mesh_key, brain_colors = loaded[hemi]()
+            widget, widget_mesh_key, shown_colors, order, rendered = brain_widgets[hemi]
+            # Widgets with another mesh are being re-rendered with the new colors already
+            if widget_mesh_key == mesh_key and shown_colors is not brain_colors:
+                palette, vertex_index = brain_colors
+                update_brain_colors(widget, palette, lod_colors(vertex_index, order))
+                brain_widgets[hemi] = (widget, widget_mesh_key, brain_colors, order, rendered)
 
     @render_plotly
     def brain_left():
-        brain = single_result_output()[1]
-        return brain['left']
+        return render_brain('left')
 
     @render_plotly
     def brain_right():
-        brain = single_result_output()[1]
-        return brain['right']
+        return render_brain('right')
 
     @render.plot(alt="All observed beta values")
     def color_legend():
-        return single_result_output()[2]
+        return loaded['legend']()
+
+    # Clicking on a brain selects a vertex: its values for all terms and measures of the model are shown below
+    # (the vertices of decimated and lower resolution meshes are numbered as in fsaverage, see backend_surfaces).
+    # The vertex tables these are read from are built (or read) in the background when a vertex of a model is first
+    # selected.
+    selected_vertex = reactive.Value(None)  # (hemi, vertex)
+    vertex_tables_load = dict(key=None, future=None)
+
+    def prepare_vertex_tables(which_model):
+        """Start building the vertex tables of a model in the background (once). Returns the future of the build."""
+        key = (all_results()['results_directory'], which_model)
+        if vertex_tables_load['key'] != key:
+            vertex_tables_load.update(key=key, future=_LOAD_POOL.submit(vertex_tables, all_results(), which_model))
+        return vertex_tables_load['future']
+
+    def select_vertex(hemi, trace, points, state):
+        if points.point_inds:
+            selected_vertex.set((hemi, int(points.point_inds[0])))
+
+    @render.ui
+    def vertex_info():
+        if selected_vertex() is None:
+            return ui.markdown('Click on a brain to show the beta values of that vertex for all terms of the model.')
+
+        hemi, vertex = selected_vertex()
+        return ui.markdown(f'Vertex **{vertex}** ({hemi} hemisphere) in all terms of **{input.select_model()}**')
+
+    @render.ui
+    def vertex_table():
+        if selected_vertex() is None:
+            return None
+
+        tables = prepare_vertex_tables(input.select_model())
+        if not tables.done():
+            reactive.invalidate_later(LOAD_POLL_INTERVAL)
+            return ui.markdown('*Reading the values of all terms...*')
+        tables.result()  # raises the error of the build, if any
+
+        table = query_vertex(all_results(), input.select_model(), *selected_vertex())
+        table['measure'] = table['measure'].map(lambda meas: styles.measure_names.get(meas, meas))
+        table['cluster'] = table['cluster'].map(lambda cluster: f'Cluster {cluster}' if cluster else '')
+        return html_table(table.drop(columns='stack'))
 
     @render.download(filename=f"verywise_figure.png")
     def download_figure_button():
-        stat_fig = plot_brain_2d(sign_betas = single_result_output()[3], 
-                                 all_observed_betas = single_result_output()[4],
-                                 model=input.select_model(),
-                                 meas=input.select_measure(),
-                                 resol=input.select_resolution(),
+        from definitions.backend_static_plots import plot_brain_2d
+
+        req(loaded['maps']())
+        sign_betas, all_betas, params = loaded['maps']()
+        stat_fig = plot_brain_2d(sign_betas = sign_betas, 
+                                 all_observed_betas = all_betas,
+                                 model=params['model'],
+                                 meas=params['measure'],
+                                 resol=params['resolution'],
                                  title=None)
         with io.BytesIO() as buf:
             stat_fig.savefig(buf, format="png")
@@ -372,12 +634,13 @@ overlap_page_content = ui.div(
             ui.input_selectize(
                 id='overlap_select_resolution',
                 label='Resolution',
-                choices={'fsaverage': 'High (164k nodes)', 'fsaverage6': 'Medium (50k nodes)', 'fsaverage5': 'Low (10k modes)'},
+                choices=RESOLUTION_CHOICES,
                 selected='fsaverage6'),
+            ui.output_ui('overlap_more_terms_ui'),
 
             ui.div(' ', style='padding-top: 80px'),
 
-            col_widths=(3, 3, 2),  # negative numbers for empty spaces
+            col_widths=(3, 3, 4, 2),  # negative numbers for empty spaces
             gap='30px',
             style=styles.SELECTION_PANE
         ),
@@ -394,4 +657,9 @@ overlap_page_content = ui.div(
             ui.card('Right hemisphere',
                     output_widget('overlap_brain_right'),
                     full_screen=True)
+        ),
+        # Pairwise overlap of the selected terms and any further ones
+        ui.layout_columns(
+            ui.card(ui.output_ui('overlap_table')),
+            col_widths=(8, -4)
         ))
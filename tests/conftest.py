@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The app is not installed as a package: make `definitions` importable from the tests
+sys.path.insert(0, str(Path(__file__).parent.parent))
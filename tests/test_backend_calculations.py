@@ -0,0 +1,113 @@
+import os
+from pathlib import Path
+
+import numpy as np
+
+from definitions.backend_calculations import cluster_stats, summarise_term
+
+
+def test_cluster_stats_skips_missing_betas():
+    sign_clusters = np.array([0, 1, 1, 1, 2, 2, 0, 3])
+    betas = np.array([9., 0.5, np.nan, -2., 1., 3., 7., np.nan])
+
+    stats = cluster_stats(sign_clusters, betas)
+
+    assert stats['n_clusters'] == 3
+    assert stats['cluster'].tolist() == [1, 2, 3]
+    # Cluster 1 has a NaN beta: it is left out of its statistics (pandas' groupby count / mean / min / max)
+    assert stats['size'].tolist() == [2, 2, 0]
+    np.testing.assert_allclose(stats['mean'][:2], [-0.75, 2.])
+    np.testing.assert_allclose(stats['min'][:2], [-2., 1.])
+    np.testing.assert_allclose(stats['max'][:2], [0.5, 3.])
+    assert stats['peak_vertex'].tolist() == [3, 5, -1]
+    np.testing.assert_allclose(stats['peak_beta'][:2], [-2., 3.])
+    # Cluster 3 has no finite beta at all
+    assert np.isnan([stats[key][2] for key in ('mean', 'min', 'max', 'peak_beta')]).all()
+
+
+def test_summarise_term_with_missing_betas():
+    summary = summarise_term(np.array([0, 1, 1, 2]), np.array([5., np.nan, 2., np.nan]))
+
+    assert summary['n_clusters'] == 2
+    assert (summary['min_beta'], summary['max_beta'], summary['mean_beta']) == (2., 2., 2.)
+    assert [c['peak_vertex'] for c in summary['clusters']] == [2, -1]
+
+
+def test_overlap_from_significance_index(tmp_path, monkeypatch):
+    import definitions.backend_io as backend_io
+    from definitions.backend_calculations import detect_models, extract_results, compute_overlaps
+
+    monkeypatch.setattr(backend_io, 'SIDECAR_DIR', str(tmp_path))  # the index is stored there
+    all_results = detect_models(str(Path(__file__).parent.parent / 'verywise_example_results'),
+                                results_format='verywise')
+    resdir, resformat = all_results['results_directory'], all_results['results_format']
+    terms = [('RP_by_wave/RP_by_wave', '6', 'area'), ('RP_by_wave/RP_by_wave', '7', 'area'),
+             ('RP_by_wave/RP_by_wave', '6', 'thickness')]
+
+    overlap = compute_overlaps(terms, all_results)
+
+    masks = [extract_results(model, term, meas, resdir, resformat)[4] for model, term, meas in terms]
+    for hemi in ['left', 'right']:
+        expected = sum((mask[hemi] > 0).astype(int) << i for i, mask in enumerate(masks))
+        np.testing.assert_array_equal(overlap['labels'][hemi], expected)
+    assert overlap['sizes'] == [sum(int((mask[hemi] > 0).sum()) for hemi in ['left', 'right']) for mask in masks]
+    assert any(name.startswith('masks.') for _, _, names in os.walk(tmp_path) for name in names)
+
+
+def test_vertex_table_is_memory_mapped(tmp_path, monkeypatch):
+    import definitions.backend_io as backend_io
+    from definitions.backend_calculations import detect_models, extract_results, vertex_table, query_vertex
+
+    monkeypatch.setattr(backend_io, 'SIDECAR_DIR', str(tmp_path))
+    all_results = detect_models(str(Path(__file__).parent.parent / 'verywise_example_results'),
+                                results_format='verywise')
+    resdir, resformat = all_results['results_directory'], all_results['results_format']
+    backend_io.RESULT_CACHE.clear()
+
+    table = vertex_table(all_results, 'RP_by_wave/RP_by_wave', 'area', 'left')
+
+    assert isinstance(table, np.memmap) and not table.flags.writeable
+    assert backend_io.RESULT_CACHE.stats()['entries'] == 0  # the maps were read past the result cache
+    assert vertex_table(all_results, 'RP_by_wave/RP_by_wave', 'area', 'left') is table
+
+    vertex = 123
+    values = query_vertex(all_results, 'RP_by_wave/RP_by_wave', 'left', vertex)
+    row = values[(values['measure'] == 'area') & (values['stack'].astype(str) == '6')].iloc[0]
+    sign_betas, all_betas = extract_results('RP_by_wave/RP_by_wave', '6', 'area', resdir, resformat)[5:7]
+    np.testing.assert_allclose(row.beta, all_betas['left'][vertex], rtol=1e-6)
+
+
+def test_directory_index_only_lists_changed_directories(tmp_path, monkeypatch):
+    import definitions.backend_io as backend_io
+    import definitions.backend_calculations as backend_calculations
+    from definitions.backend_calculations import parse_directory_structure, INDEX_FILENAME
+
+    monkeypatch.setattr(backend_io, 'SIDECAR_DIR', str(tmp_path / 'sidecars'))
+    resdir = tmp_path / 'results'
+    for folder, file_name in [('model_a', 'lh.area.stack2.coef.mgh'), ('model_a', 'rh.area.stack2.coef.mgh'),
+                              ('model_b', 'lh.thickness.stack3.coef.mgh')]:
+        (resdir / folder).mkdir(parents=True, exist_ok=True)
+        (resdir / folder / file_name).touch()
+
+    rows = parse_directory_structure(resdir, 'verywise')
+    assert sorted(rows) == [['model_a', 'model_a', 'lh', 'area', 2], ['model_a', 'model_a', 'rh', 'area', 2],
+                            ['model_b', 'model_b', 'lh', 'thickness', 3]]
+    assert os.path.isfile(backend_io.sidecar_path(str(resdir), INDEX_FILENAME))
+
+    # Unchanged directories are not listed again; a new file is found in the directory it was added to
+    listed = []
+    list_result_directory = backend_calculations.list_result_directory
+    monkeypatch.setattr(backend_calculations, 'list_result_directory',
+                        lambda path: listed.append(os.path.basename(path)) or list_result_directory(path))
+    assert sorted(parse_directory_structure(resdir, 'verywise')) == sorted(rows)
+    assert listed == []
+
+    (resdir / 'model_b' / 'rh.thickness.stack3.coef.mgh').touch()
+    os.utime(resdir / 'model_b', ns=(0, os.stat(resdir / 'model_b').st_mtime_ns + 10 ** 9))
+    assert ['model_b', 'model_b', 'rh', 'thickness', 3] in parse_directory_structure(resdir, 'verywise')
+    assert listed == ['model_b']
+
+    # An index of another version (or that cannot be parsed) is ignored
+    with open(backend_io.sidecar_path(str(resdir), INDEX_FILENAME), 'w') as f:
+        f.write('{"version": 0, "dirs": {')
+    assert len(parse_directory_structure(resdir, 'verywise')) == 4
@@ -0,0 +1,37 @@
+import os
+
+import numpy as np
+
+from definitions.backend_io import SharedArrayStore, SidecarCache
+
+
+def test_shared_store_prune_keeps_lock_files(tmp_path):
+    store = SharedArrayStore(str(tmp_path), max_bytes=1000)
+
+    for key in range(20):
+        array = store.get_or_create(('map', key), lambda: np.full(100, key, dtype=np.float64))
+        assert array[0] == key
+
+    names = os.listdir(tmp_path)
+    arrays = [name for name in names if name.endswith('.npy')]
+    locks = [name for name in names if name.endswith('.lock')]
+
+    assert len(arrays) == 1  # the newest array only (800 bytes of data per array)
+    # Lock files are shared by the arrays of a hash bucket and never removed
+    assert {store.lock_path(store.path(('map', key))) + '.lock' for key in range(20)} <= \
+        {os.path.join(tmp_path, name) for name in locks}
+
+
+def test_sidecar_cache_replaces_changed_sources():
+    cache = SidecarCache(max_entries=2)
+
+    cache.put('a.npz', 'v1', 1)
+    assert cache.get('a.npz', 'v1') == 1
+    cache.put('a.npz', 'v2', 2)  # the maps of the index changed
+    assert cache.get('a.npz', 'v1') is None and cache.get('a.npz', 'v2') == 2
+    assert len(cache) == 1
+
+    cache.put('b.npz', 'v1', 3)
+    cache.get('a.npz', 'v2')
+    cache.put('c.npz', 'v1', 4)  # evicts b, the least recently used
+    assert len(cache) == 2 and cache.get('b.npz', 'v1') is None and cache.get('a.npz', 'v2') == 2
@@ -0,0 +1,127 @@
+import json
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pytest
+
+import definitions.backend_remote as backend_remote
+
+# A fake GitHub contents API: a folder with a sub-folder, served on localhost
+FILES = {'model/lh.area.stack2.coef.mgh': b'coef', 'model/stack_names.txt': b'stack_number\tstack_name\n',
+         'model/sub/rh.area.stack2.coef.mgh': b'more coef'}
+
+
+@pytest.fixture
+def contents_api():
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = urlparse(self.path).path
+            requests_seen.append(path)
+            root = f'http://127.0.0.1:{self.server.server_port}'
+
+            if path.startswith('/raw/'):
+                body = FILES[path[len('/raw/'):]]
+            elif path.startswith('/repos/user/repo/contents/'):
+                folder = path[len('/repos/user/repo/contents/'):]
+                entries = {}
+                for file_path in FILES:
+                    if file_path.startswith(f'{folder}/'):
+                        name = file_path[len(folder) + 1:].split('/')[0]
+                        if '/' in file_path[len(folder) + 1:]:
+                            entries[name] = dict(name=name, type='dir',
+                                                 url=f'{root}/repos/user/repo/contents/{folder}/{name}?ref=main')
+                        else:
+                            entries[name] = dict(name=name, type='file', sha=hashlib.sha1(FILES[file_path]).hexdigest(),
+                                                 download_url=f'{root}/raw/{file_path}')
+                body = json.dumps(list(entries.values())).encode()
+            else:
+                self.send_error(404)
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}', requests_seen
+    server.shutdown()
+    server.server_close()
+
+
+def test_second_sync_downloads_nothing(contents_api, tmp_path):
+    api_root, requests_seen = contents_api
+    url = 'https://github.com/user/repo/tree/main/model'
+
+    folder = backend_remote.download_github_folder(url, download_loc=tmp_path, api_root=api_root)
+    for file_path, content in FILES.items():
+        assert (folder / file_path[len('model/'):]).read_bytes() == content
+    assert sum(path.startswith('/raw/') for path in requests_seen) == len(FILES)
+
+    backend_remote._GITHUB_FOLDER_CACHE.clear()  # as after a restart: only the manifest is left
+    requests_seen.clear()
+    assert backend_remote.download_github_folder(url, download_loc=tmp_path, api_root=api_root) == folder
+    assert requests_seen and not any(path.startswith('/raw/') for path in requests_seen)
+
+
+def test_folders_are_synced_separately(contents_api, tmp_path, monkeypatch):
+    api_root, requests_seen = contents_api
+    monkeypatch.setattr(backend_remote, '_GITHUB_FOLDER_CACHE', {})
+    url, sub_url = 'https://github.com/user/repo/tree/main/model', 'https://github.com/user/repo/tree/main/model/sub'
+
+    folder = backend_remote.download_github_folder(url, download_loc=tmp_path, api_root=api_root)
+    sub_folder = backend_remote.download_github_folder(sub_url, download_loc=tmp_path, api_root=api_root)
+
+    assert folder != sub_folder
+    assert (folder / 'stack_names.txt').is_file()  # not removed by the sync of the other folder
+    assert (sub_folder / 'rh.area.stack2.coef.mgh').read_bytes() == FILES['model/sub/rh.area.stack2.coef.mgh']
+
+    backend_remote._GITHUB_FOLDER_CACHE.clear()
+    requests_seen.clear()
+    assert backend_remote.download_github_folder(url, download_loc=tmp_path, api_root=api_root) == folder
+    assert not any(path.startswith('/raw/') for path in requests_seen)  # its manifest was kept
+
+
+@pytest.mark.parametrize('extension', ['.zip', '.tar.gz'])
+def test_archive_extracts_results_only(tmp_path, extension):
+    import io
+    import os
+    import tarfile
+    import zipfile
+
+    members = {'study/model/lh.area.stack2.coef.mgh': b'coef', 'study/model/stack_names.txt': b'names',
+               'study/model/lh.area.stack2.cache.th30.abs.sig.ocn.mgh': b'ocn', 'study/model/notes.pdf': b'notes',
+               '../outside.coef.mgh': b'evil'}
+    archive = tmp_path / f'results{extension}'
+    if extension == '.zip':
+        with zipfile.ZipFile(archive, 'w') as zf:
+            for name, content in members.items():
+                zf.writestr(name, content)
+    else:
+        with tarfile.open(archive, 'w:gz') as tf:
+            for name, content in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tf.addfile(info, io.BytesIO(content))
+
+    resdir = backend_remote.extract_results_archive(archive, download_loc=tmp_path / 'downloads')
+
+    assert resdir.name == 'study'  # the single top-level folder of the archive
+    assert sorted(os.listdir(resdir / 'model')) == ['lh.area.stack2.cache.th30.abs.sig.ocn.mgh',
+                                                   'lh.area.stack2.coef.mgh', 'stack_names.txt']
+    assert (resdir / 'model' / 'lh.area.stack2.coef.mgh').read_bytes() == b'coef'
+    assert not any(name == 'outside.coef.mgh' for _, _, names in os.walk(tmp_path) for name in names)
+
+    # Not extracted again while the archive is unchanged
+    (resdir / 'model' / 'stack_names.txt').write_bytes(b'edited')
+    assert backend_remote.extract_results_archive(archive, download_loc=tmp_path / 'downloads') == resdir
+    assert (resdir / 'model' / 'stack_names.txt').read_bytes() == b'edited'
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import pytest
+
+import definitions.backend_static_plots as backend_static_plots
+from definitions.backend_static_plots import rasterize_faces, brain_mosaic, brain_panel_index, panel_face_index, \
+    draw_brain_panel, BRAIN_PANELS
+from definitions.backend_surfaces import FsaverageSurfaces
+
+
+def test_rasterize_faces_covers_and_sorts_faces():
+    # A 4 x 4 pixel square (two faces along its diagonal) at depth 1, and a face in front of its lower left corner
+    xy = np.array([[0., 0.], [4., 0.], [4., 4.], [0., 4.], [0., 0.], [2., 0.], [0., 2.]])
+    depth = np.array([1., 1., 1., 1., 0., 0., 0.])
+    faces = np.array([[0, 1, 2], [0, 2, 3], [4, 5, 6]])
+
+    index = rasterize_faces(xy, depth, faces, width=6, height=5)
+
+    # Row 0 is the top of the image; pixel centres on the diagonal of the square are in both of its faces
+    np.testing.assert_array_equal(index, [[-1, -1, -1, -1, -1, -1],
+                                          [1, 1, 1, 0, -1, -1],
+                                          [1, 1, 0, 0, -1, -1],
+                                          [2, 0, 0, 0, -1, -1],
+                                          [2, 2, 0, 0, -1, -1]])
+
+
+@pytest.mark.parametrize('panel', ['A', 'C'])
+def test_raster_panels_cover_the_matplotlib_brains(panel):
+    fs_avg = FsaverageSurfaces('fsaverage5')
+    hemi_colors = {hemi: (fs_avg[f'pial_{hemi}'], np.tile([0., 0., 0., 1.], (len(fs_avg[f'pial_{hemi}'].faces), 1)))
+                   for hemi in ['left', 'right']}
+
+    fig = plt.figure(figsize=(12, 7), dpi=50)
+    top, left, index = brain_panel_index(brain_mosaic(fig)[panel], panel,
+                                         [hemi_colors[hemi][0] for hemi, view in BRAIN_PANELS[panel]])
+    raster = np.zeros(fig.canvas.get_width_height()[::-1], dtype=bool)
+    raster[top:top + index.shape[0], left:left + index.shape[1]] = index >= 0
+
+    fig = plt.figure(figsize=(12, 7), dpi=50)
+    axs = brain_mosaic(fig)
+    for other in set(axs) - {panel}:
+        axs[other].remove()
+    draw_brain_panel(axs[panel], panel, hemi_colors)
+    fig.canvas.draw()
+    drawn = np.asarray(fig.canvas.buffer_rgba())[..., :3].min(axis=2) < 128
+    plt.close('all')
+
+    # Same silhouette (up to the edges matplotlib draws around the faces)
+    assert (raster & drawn).sum() / (raster | drawn).sum() > 0.9
+
+
+def test_panel_face_index_is_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend_static_plots, 'VIEW_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(backend_static_plots, '_VIEW_INDEX', {})
+    fs_avg = FsaverageSurfaces('fsaverage5')
+    meshes = [fs_avg[f'pial_{hemi}'] for hemi, view in BRAIN_PANELS['D']]
+
+    fig = plt.figure(figsize=(12, 7), dpi=50)
+    top, left, index = panel_face_index(brain_mosaic(fig)['D'], 'D', meshes)
+    assert sorted(name.rsplit('_', 1)[-1] for name in os.listdir(tmp_path) if name.endswith('.npy')) == \
+        ['index.npy', 'origin.npy']
+
+    # Another process (empty in-memory index) reads the stored index
+    monkeypatch.setattr(backend_static_plots, '_VIEW_INDEX', {})
+    monkeypatch.setattr(backend_static_plots, 'brain_panel_index', lambda *args: pytest.fail('index computed again'))
+    fig = plt.figure(figsize=(12, 7), dpi=50)
+    cached = panel_face_index(brain_mosaic(fig)['D'], 'D', meshes)
+    plt.close('all')
+
+    assert cached[:2] == (top, left)
+    np.testing.assert_array_equal(cached[2], index)
@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+import pytest
+
+from definitions.backend_io import load_map, ResultCache, PACK_FILENAME
+from definitions.backend_store import pack_model_directory
+
+
+def write_mgh(path, values):
+    import nibabel as nb
+
+    nb.save(nb.MGHImage(np.asarray(values, dtype=np.float32).reshape(-1, 1, 1), np.eye(4)), str(path))
+
+
+def test_pack_serves_only_unchanged_maps(tmp_path):
+    write_mgh(tmp_path / 'lh.area.stack2.coef.mgh', [1., 2., 3.])
+    write_mgh(tmp_path / 'lh.area.stack3.coef.mgh', [4., 5., 6.])
+    assert pack_model_directory(str(tmp_path)) == os.path.join(str(tmp_path), PACK_FILENAME)
+
+    np.testing.assert_array_equal(load_map(str(tmp_path / 'lh.area.stack2.coef.mgh'), cache=ResultCache(0)), [1, 2, 3])
+
+    write_mgh(tmp_path / 'lh.area.stack2.coef.mgh', [7., 8., 9.])  # same size, newer mtime
+    st = os.stat(tmp_path / 'lh.area.stack2.coef.mgh')
+    os.utime(tmp_path / 'lh.area.stack2.coef.mgh', ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+    with pytest.warns(UserWarning, match='changed since it was packed'):
+        changed = load_map(str(tmp_path / 'lh.area.stack2.coef.mgh'), cache=ResultCache(0), shared_store=None)
+    np.testing.assert_array_equal(changed, [7, 8, 9])
+    np.testing.assert_array_equal(load_map(str(tmp_path / 'lh.area.stack3.coef.mgh'), cache=ResultCache(0)), [4, 5, 6])
+
+    # Maps removed after packing are still served from the pack
+    os.remove(tmp_path / 'lh.area.stack3.coef.mgh')
+    np.testing.assert_array_equal(load_map(str(tmp_path / 'lh.area.stack3.coef.mgh'), cache=ResultCache(0)), [4, 5, 6])
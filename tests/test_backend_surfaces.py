@@ -0,0 +1,33 @@
+import numpy as np
+
+import definitions.backend_surfaces as backend_surfaces
+from definitions.backend_surfaces import downsample_map, midpoint_ends, get_surface, ico_nodes
+
+
+def test_max_downsampling_keeps_small_clusters(monkeypatch):
+    # fsaverage5 is the lowest resolution the app shows: downsample it to an order-4 icosahedron instead, so that the
+    # source mesh is one that can be loaded without a download
+    monkeypatch.setitem(backend_surfaces.N_NODES, 'fsaverage4', ico_nodes(4))
+    monkeypatch.setitem(backend_surfaces.ICO_ORDER, 'fsaverage4', 4)
+    monkeypatch.setattr(backend_surfaces, 'SURFACE_CACHE_DIR', None)
+    monkeypatch.setattr(backend_surfaces, '_OPERATORS', {})
+
+    n_coarse = ico_nodes(4)
+    ends = midpoint_ends(get_surface('fsaverage5', 'pial_left').faces, n_coarse)
+
+    # A one-vertex cluster on a vertex that only exists on the finer mesh, and a larger one around a coarse vertex
+    clusters = np.zeros(ico_nodes(5))
+    clusters[n_coarse + 100] = 2
+    clusters[np.flatnonzero((ends == 7).any(axis=1)) + n_coarse] = 1
+    clusters[7] = 1
+
+    assert 2 not in clusters[:n_coarse]  # i.e. lost when only the shared vertices are sampled
+    labels = downsample_map(clusters, 'fsaverage4', 'left', how='max')
+
+    assert labels.shape == (n_coarse,)
+    assert set(np.flatnonzero(labels == 2)) <= set(ends[100]) and (labels == 2).any()
+    assert labels[7] == 1 and set(np.unique(labels)) == {0, 1, 2}
+
+    # The mean of the same map blurs the small cluster into its neighbours instead
+    means = downsample_map(clusters, 'fsaverage4', 'left')
+    assert 0 < means[ends[100]].max() < 2